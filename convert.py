@@ -1,58 +1,74 @@
 #!/usr/bin/env python
 
 import json
-import logging
 import os
+import sys
 import subprocess
+import shutil
+import threading
 # Regular expression support for files and file content
 import re
-# Print dictionaries and JSON content in a pretty and human readable manner
-import pprint
 # Enable timers
 import time
-# Add ffmpeg progress bar https://github.com/althonos/ffpb
-import ffpb
 # Handle when user leverages Ctrl-C to terminate operations
 import signal
-# https://www.geeksforgeeks.org/print-colors-python-terminal/
-from colorama import Fore, Back, Style
-# Added to ensure target directory path exists
-from pathlib import Path
-# Search for files using glob function
-from glob import glob
+from collections import deque
+import bisect
+# Compact chapter tables
+from array import array
+# Heavier modules are imported by the functions that need them, so that the command line
+# starts quickly for single files: sqlite3 (caches and queue), colorama (colored output),
+# concurrent.futures (parallel jobs), tempfile (scratch files), hashlib (manifest),
+# socket, urllib.request and http.server (queue workers and coordinator)
 
 # TODO: Add the ability to entirely quit the whole program (Ctrl-C only causes encoding to stop and go to next file)
 
-# TODO: Collect/Track file sizes as we detect files and then determine if target directory has enough free space
-# but the problem might be if we upscale/etc, then file sizes will be bigger, but at least warn when its not enough
-# or very close
-
-# TODO: Collect/Track file sizes for each conversion task and at the end state "Previous storage: X, New storage: Y" to show storage savings
-
 # TODO: ensure stdout of program goes into a log file
 # https://docs.python.org/3/howto/logging.html
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
 
-#TODO: Add arguments
+# Default settings, most of them can be overridden on the command line (see parse_arguments)
 arg_verbose = True
 arg_interactive = False # false (default), true (ask to continue after each file)
 arg_convert = True # false (default, dryrun), true (convert files)
 arg_recursive = False # false (default), true
-arg_chapters = "copy" # copy (default), remove, duration, detect-scenes
+arg_chapters = "copy" # copy (default), remove, duration, detect-scenes (generated chapters only when the source has none)
+arg_chapter_scene_threshold = 0.4 # scene change score (0-1) to consider as a chapter boundary
+arg_chapter_black_duration = 0.5 # minimum black interval in seconds
+arg_chapter_black_threshold = 0.1 # pixel brightness (0-1) below which a pixel counts as black
+arg_chapter_min_length = 180 # minimum chapter length in seconds
 arg_subtitles = "copy" # copy (default), remove
 # --thumbnail = generate thumbnail inside container?
 # --language = preferred language
 arg_overwrite = False # false (default), true (overwrite files)
+arg_passthrough = "link" # link (default, reflink or hardlink sources that need no change), rename (move them), off (always remux)
 arg_upscaling = False # false (default), true
 arg_downscaling = True # false (default), true
+arg_jobs = None # None (default, encoder profile or 1), N (convert N files in parallel)
+arg_threads = os.cpu_count() or 1 # total ffmpeg threads shared by all parallel jobs
+arg_segments = 0 # 0 (default, disabled), N (encode long files as N segments in parallel)
+arg_segment_min_duration = 1800 # only split files longer than this many seconds
+arg_free_space_reserve = 1024**3 # bytes kept free on the target filesystem
+arg_probe_jobs = 4 # number of ffprobe processes running ahead of the encoder
+arg_probe_prefetch = 8 # number of files probed ahead of the encoder
+arg_metrics = None # JSON lines file receiving a record per stage span (walk, probe, plan, encode, ...), None disables
+arg_metrics_prometheus = None # Prometheus textfile written at the end of a run, None disables
 
 # Source information
 #arg_source_directory = r"./media/"
 arg_source_directory = r"/Volumes/VIDEOS/Movies_old/"
 arg_source_formats = ["mkv", "divx", "mp4", "m4p", "m4v", "mov", "qt", "ogg", "avi", "mpg", "wmv", "flv", "m2ts", "mpeg"]
 arg_source_subtitle_formats = ["idx", "srt"]
-FFMETADATA_FILE = "/tmp/FFMETADATAFILE"
+arg_probe_cache = r"~/.cache/media-manager/ffprobe.sqlite" # None disables the ffprobe cache
+arg_probe_cache_size = 100000 # maximum cached files, least recently used are evicted
+arg_ffmpeg_capabilities = r"~/.cache/media-manager/ffmpeg-capabilities.json" # None disables the capability cache
+arg_incremental = True # true (default, skip sources already converted with the same settings), false
+arg_manifest = r"~/.cache/media-manager/manifest.sqlite" # record of converted sources
+arg_queue = r"~/.cache/media-manager/queue.sqlite" # persistent job queue shared by `queue` commands
+arg_queue_poll = 5 # seconds between lease renewals and checks of a paused queue or for cancelled jobs
+arg_lease_seconds = 60 # a job is reclaimed when its worker does not renew the lease in time
+arg_coordinator = "127.0.0.1:8765" # address the coordinator listens on for remote workers, e.g. "0.0.0.0:8765"
+arg_coordinator_token = None # shared secret of the coordinator and its workers, None reads MEDIA_MANAGER_TOKEN
+arg_path_map = [] # workers: [("/Volumes/VIDEOS/", "/mnt/videos/")] coordinator path prefix -> local prefix
 
 # Target information
 # TODO: Careful when converting input to same output filename in same folder! 
@@ -68,148 +84,651 @@ target_audio_codec = "aac" # AAC
 target_subtitle_codec = "srt" # SRT (Subrip)
 target_primary_language = "eng" # English
 target_temp_dir = "/tmp"
+target_encoder_profile = r"~/.config/media-manager/encoder-profile.json" # written by the benchmark command
+
+# Benchmark settings, every combination of preset, threads and concurrent jobs is measured
+arg_benchmark_samples = 3 # number of library files to sample
+arg_benchmark_seconds = 20 # length of each encoded segment
+arg_benchmark_presets = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium"]
+arg_benchmark_threads = [0, 2, 4, 8] # 0 lets ffmpeg decide
+arg_benchmark_jobs = [1, 2, 4]
+arg_benchmark_bitrate_tolerance = 1.3 # accept presets up to 30% above the lowest measured bitrate
+
+# Codecs the target accepts as-is, streams in these codecs are copied instead of encoded
+target_copy_codecs = {
+    "video": {"h264"},
+    "audio": {"aac"},
+    "subtitle": {"subrip"},
+}
+target_video_pix_fmts = {"yuv420p", "yuvj420p"} # 8-bit 4:2:0, Roku does not play 10-bit H.264
+# Subtitles that can be converted to srt, bitmap subtitles (PGS, VobSub, DVB) can not
+text_subtitle_codecs = {"subrip", "ass", "ssa", "mov_text", "webvtt", "text", "subviewer", "microdvd",
+                        "sami", "realtext", "jacosub", "mpl2", "pjs", "stl", "vplayer"}
 
 def signal_handler(signal, frame):
     print('You pressed Ctrl+C! Exiting ... ')
     exit(0)
 
+# https://www.geeksforgeeks.org/print-colors-python-terminal/
 def print_error(msg):
+    from colorama import Fore, Style
     print(Fore.RED + msg + Style.RESET_ALL)
 
 def print_dim(msg):
+    from colorama import Style
     print(Style.DIM + msg + Style.RESET_ALL)
 
+# Terminal width falls back to 80 columns when the output is not a terminal (cron, pipes)
 def print_header(message: str):
+    from colorama import Fore, Style
     prefix = message
-    size = os.get_terminal_size()
+    size = shutil.get_terminal_size()
     line = prefix + " " + ("-" * (size.columns - len(prefix) - 5))
     print("\n")
     print(Fore.GREEN + line + Style.RESET_ALL)
 
 def print_task(message: str):
+    from colorama import Fore, Style
     prefix = "\nTASK: " + message
-    size = os.get_terminal_size()
+    size = shutil.get_terminal_size()
     line = prefix + " " + ("*" * (size.columns - len(prefix) - 5))
     print(Fore.GREEN + line + Style.RESET_ALL)
 
+# Timing of the stages of a conversion (walk, probe, plan, chapters, encode, copy, post-validate)
+# A span measures the wall time of a stage for one source, plus the CPU time, peak memory and
+# bytes read and written of the ffmpeg processes it ran. Spans are appended to `arg_metrics`
+# as JSON lines when they end and summed up per stage for the summary and Prometheus.
+_metrics_lock = threading.Lock()
+_metrics_local = threading.local()
+_metrics_stages = {}
+
+class Span:
+    __slots__ = ("stage", "source", "start", "elapsed", "status", "children", "cpu_user", "cpu_system",
+                 "max_rss", "read_bytes", "written_bytes", "parent", "_perf")
+
+    def __init__(self, stage, source=None):
+        self.stage = stage
+        self.source = source
+        self.start = time.time()
+        self.elapsed = 0.0
+        self.status = "ok"
+        self.children = 0 # ffmpeg processes
+        self.cpu_user = 0.0
+        self.cpu_system = 0.0
+        self.max_rss = 0 # bytes
+        self.read_bytes = 0 # all reads and writes of the processes, including pipes (rchar and wchar)
+        self.written_bytes = 0
+        self.parent = None
+        self._perf = time.perf_counter()
+
+    def __enter__(self):
+        self.parent = current_span()
+        _metrics_local.span = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _metrics_local.span = self.parent
+        self.elapsed = time.perf_counter() - self._perf
+        if exc_type is not None:
+            self.status = "error"
+        metrics_record(self)
+        return False
+
+    # Resource usage of a finished child process (os.wait4) and its I/O counters (/proc/<pid>/io)
+    def add_child(self, rusage, io):
+        with _metrics_lock:
+            self.children += 1
+            self.cpu_user += rusage.ru_utime
+            self.cpu_system += rusage.ru_stime
+            # kilobytes on Linux, bytes on macOS
+            self.max_rss = max(self.max_rss, rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024))
+            self.read_bytes += io.get("rchar", 0)
+            self.written_bytes += io.get("wchar", 0)
+
+    def record(self):
+        return {"time": round(self.start, 3), "stage": self.stage, "source": self.source,
+                "elapsed": round(self.elapsed, 3), "status": self.status, "children": self.children,
+                "cpu_user": round(self.cpu_user, 3), "cpu_system": round(self.cpu_system, 3),
+                "max_rss": self.max_rss, "read_bytes": self.read_bytes, "written_bytes": self.written_bytes,
+                "pid": os.getpid()}
+
+def current_span():
+    return getattr(_metrics_local, "span", None)
+
+def metrics_record(span):
+    with _metrics_lock:
+        totals = _metrics_stages.setdefault(span.stage, {
+            "spans": 0, "errors": 0, "seconds": 0.0, "cpu_seconds": 0.0, "max_rss": 0,
+            "read_bytes": 0, "written_bytes": 0, "children": 0})
+        totals["spans"] += 1
+        totals["errors"] += span.status != "ok"
+        totals["seconds"] += span.elapsed
+        totals["cpu_seconds"] += span.cpu_user + span.cpu_system
+        totals["max_rss"] = max(totals["max_rss"], span.max_rss)
+        totals["read_bytes"] += span.read_bytes
+        totals["written_bytes"] += span.written_bytes
+        totals["children"] += span.children
+        if arg_metrics:
+            path = os.path.expanduser(arg_metrics)
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "a") as f:
+                f.write(json.dumps(span.record()) + "\n")
+
+# Counters of /proc/<pid>/io (Linux), empty elsewhere
+def proc_io(pid):
+    io = {}
+    try:
+        with open("/proc/%s/io" % pid) as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                io[key] = _to_int(value.strip())
+    except OSError:
+        pass
+    return io
+
+# Wait for a child process and add its resource usage to the span of the calling thread
+# The process is reaped with os.wait4 once its I/O counters were read, where available
+def wait_child(process, span=None):
+    span = span or current_span()
+    if span is None or process.returncode is not None or not hasattr(os, "wait4"):
+        return process.wait()
+    try:
+        if hasattr(os, "waitid"):
+            # Exited but not reaped yet, /proc/<pid>/io is still readable
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        io = proc_io(process.pid)
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        return process.wait()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    span.add_child(rusage, io)
+    return process.returncode
+
+# Run a command to completion, returns its exit code and output
+# Its resources count towards `span` or the span of the calling thread
+def run_child(command, span=None, stderr=subprocess.DEVNULL):
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr, text=True)
+    with process.stdout:
+        output = process.stdout.read()
+    return wait_child(process, span), output
+
+# Time and resources per stage, as seen where the hours of a batch go
+def print_metrics():
+    if not _metrics_stages:
+        return
+    print("\nStage            spans    seconds   cpu seconds   peak RSS MB   read MB   written MB")
+    for stage, t in sorted(_metrics_stages.items(), key=lambda item: -item[1]["seconds"]):
+        print("%-14s %7s %10.1f %13.1f %13.1f %9.1f %12.1f" % (
+            stage, t["spans"], t["seconds"], t["cpu_seconds"], mb(t["max_rss"]),
+            mb(t["read_bytes"]), mb(t["written_bytes"])))
+
+# Write the stage totals in the Prometheus text format, e.g. for the node_exporter textfile collector
+def write_prometheus_metrics(path):
+    metrics = [
+        ("spans_total", "counter", "Stage spans finished", "spans"),
+        ("errors_total", "counter", "Stage spans that raised an error", "errors"),
+        ("seconds_total", "counter", "Wall time spent in the stage", "seconds"),
+        ("cpu_seconds_total", "counter", "CPU time of the ffmpeg processes of the stage", "cpu_seconds"),
+        ("max_rss_bytes", "gauge", "Peak resident memory of an ffmpeg process of the stage", "max_rss"),
+        ("read_bytes_total", "counter", "Bytes read by the ffmpeg processes of the stage", "read_bytes"),
+        ("written_bytes_total", "counter", "Bytes written by the ffmpeg processes of the stage", "written_bytes"),
+        ("processes_total", "counter", "ffmpeg processes run by the stage", "children"),
+    ]
+    lines = []
+    with _metrics_lock:
+        for name, kind, help_text, key in metrics:
+            lines.append("# HELP media_manager_stage_%s %s" % (name, help_text))
+            lines.append("# TYPE media_manager_stage_%s %s" % (name, kind))
+            for stage, totals in sorted(_metrics_stages.items()):
+                lines.append('media_manager_stage_%s{stage="%s"} %s' % (name, stage, round(totals[key], 3)))
+    lines.append("# HELP media_manager_last_run_timestamp_seconds End of the last run")
+    lines.append("# TYPE media_manager_last_run_timestamp_seconds gauge")
+    lines.append("media_manager_last_run_timestamp_seconds %s" % round(time.time(), 3))
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Collectors must never see a partially written file
+    temp_path = "%s.%s" % (path, os.getpid())
+    with open(temp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temp_path, path)
+
+# ffprobe results cached on disk and keyed by (absolute path, size, mtime, inode)
+_probe_cache = None
+_probe_cache_lock = threading.Lock()
+PROBE_CACHE_TOUCH_SECONDS = 86400 # the access time of a hit is only written when it is older than this
+
+# Open (and create) a SQLite database shared by all worker threads
+def open_database(filepath):
+    path = os.path.expanduser(filepath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    import sqlite3
+    # Wait for other processes holding a write lock (queue workers)
+    db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+def probe_cache():
+    global _probe_cache
+    if _probe_cache is None and arg_probe_cache:
+        db = open_database(arg_probe_cache)
+        db.execute("""CREATE TABLE IF NOT EXISTS probe (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            inode INTEGER,
+            result TEXT,
+            accessed REAL)""")
+        db.execute("CREATE INDEX IF NOT EXISTS probe_accessed ON probe (accessed)")
+        db.commit()
+        _probe_cache = db
+    return _probe_cache
+
+def probe_cache_get(path, st):
+    db = probe_cache()
+    if db is None:
+        return None
+    with _probe_cache_lock:
+        row = db.execute("SELECT size, mtime_ns, inode, result, accessed FROM probe WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        if row[:3] != (st.st_size, st.st_mtime_ns, st.st_ino):
+            # File changed since it was probed
+            db.execute("DELETE FROM probe WHERE path = ?", (path,))
+            db.commit()
+            return None
+        # A daily access time is enough for the eviction order, a rescan of an unchanged library stays read only
+        now = time.time()
+        if now - (row[4] or 0) > PROBE_CACHE_TOUCH_SECONDS:
+            db.execute("UPDATE probe SET accessed = ? WHERE path = ?", (now, path))
+            db.commit()
+    return json.loads(row[3])
+
+def probe_cache_put(path, st, results):
+    db = probe_cache()
+    if db is None:
+        return
+    with _probe_cache_lock:
+        db.execute("INSERT OR REPLACE INTO probe VALUES (?, ?, ?, ?, ?, ?)",
+                   (path, st.st_size, st.st_mtime_ns, st.st_ino, json.dumps(results), time.time()))
+        # Evict least recently used entries above the size cap
+        count = db.execute("SELECT COUNT(*) FROM probe").fetchone()[0]
+        if count > arg_probe_cache_size:
+            db.execute("DELETE FROM probe WHERE path IN (SELECT path FROM probe ORDER BY accessed LIMIT ?)",
+                       (count - arg_probe_cache_size,))
+        db.commit()
+
 def ffprobe(filepath):
+    path = os.path.abspath(filepath)
     try:
-        #TODO: Use args instead, to avoid issues with filepath having spaces and quotes in it
-        prefix = "ffprobe -v quiet -print_format json"
-        command = prefix + " -show_chapters -show_format -show_streams \"{}\"".format(filepath)
-        if arg_verbose:
-            print("    ... command: ", command)
-        results = json.loads(subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True))
-    except:
+        st = os.stat(path)
+    except OSError:
         return {}
+    results = probe_cache_get(path, st)
+    if results is not None:
+        if arg_verbose:
+            print("    ... probe cache hit")
+        return results
+    results = ffprobe_uncached(filepath)
+    if results:
+        probe_cache_put(path, st, results)
     return results
 
-def get_chapter_count(info):
-    # TODO: Use dict.get() operation for the rest of my code like below:
-    x = len(info.get('chapters', []))
-    return x
-
-def get_stream_count(info):
-    for k, v in info.items():
-        if k == "streams":
-            return len(v)
-    return 0
-
-
-def get_video_stream_count(info):
-    count = 0
-    for k, v in info.items():
-        if k == "streams":
-            for s in v:
-                if s["codec_type"] == "video":
-                    count = count + 1
-    return count
-
-def get_video_duration(info):
-    x = info["format"]["duration"]
-    return float(x) 
-
-def get_video_codec(info):
-    streams = info["streams"]
-    for s in streams:
-        if s["codec_type"] == "video":
-            return s["codec_name"]
-        else:
-            return ""
-
-def get_video_width(info):
-    streams = info["streams"]
-    for s in streams:
-        if s["codec_type"] == "video":
-            return s["width"]
-        else:
-            return 0
-
-def get_video_height(info):
-    streams = info["streams"]
-    for s in streams:
-        if s["codec_type"] == "video":
-            return s["height"]
-        else:
-            return 0
-
-def get_audio_stream_count(info):
-    streams = info["streams"]
-    count = 0
-    for s in streams:
-        if s["codec_type"] == "audio":
-            count = count + 1
-    return count
-
-
-def get_audio_codec(info):
-    streams = info["streams"]
-    for s in streams:
-        if s["codec_type"] == "audio":
-            return s["codec_name"]
-
-
-def get_subtitle_stream_count(info):
-    streams = info["streams"]
-    count = 0
-    for s in streams:
-        if s["codec_type"] == "subtitle":
-            count = count + 1
-    return count
+# Probe a file without the cache, for files that are about to change (partial targets)
+def ffprobe_uncached(filepath):
+    command = ["ffprobe", "-v", "quiet", "-print_format", "json",
+               "-show_chapters", "-show_format", "-show_streams", filepath]
+    if arg_verbose:
+        print("    ... command: ", " ".join(command))
+    try:
+        returncode, output = run_child(command)
+        if returncode != 0:
+            return {}
+        return json.loads(output)
+    except (OSError, ValueError):
+        return {}
 
+# Content fingerprint of a file: size plus a hash of samples from the start, middle and end
+def file_fingerprint(filepath, size, sample=64 * 1024):
+    import hashlib
+    h = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(filepath, "rb") as f:
+        for offset in sorted({0, max(0, size // 2 - sample // 2), max(0, size - sample)}):
+            f.seek(offset)
+            h.update(f.read(sample))
+    return h.hexdigest()
+
+# Settings that influence the converted file, a change forces a new conversion
+def conversion_settings():
+    settings = {
+        "container": target_container,
+        "video_codec": target_video_codec,
+        "video_quality": target_video_quality,
+        "audio_codec": target_audio_codec,
+        "subtitle_codec": target_subtitle_codec,
+        "copy_codecs": {k: sorted(v) for k, v in target_copy_codecs.items()},
+        "upscaling": arg_upscaling,
+        "downscaling": arg_downscaling,
+        "chapters": arg_chapters,
+        "subtitles": arg_subtitles,
+    }
+    return json.dumps(settings, sort_keys=True)
+
+# Manifest of converted sources with their fingerprint, settings and target
+_manifest = None
+_manifest_lock = threading.Lock()
+
+def manifest():
+    global _manifest
+    if _manifest is None:
+        db = open_database(arg_manifest)
+        db.execute("""CREATE TABLE IF NOT EXISTS manifest (
+            source TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            inode INTEGER,
+            fingerprint TEXT,
+            settings TEXT,
+            target TEXT,
+            converted REAL)""")
+        db.commit()
+        _manifest = db
+    return _manifest
+
+# Check if the source was already converted to the target with the current settings
+def manifest_is_current(source_f_path, target_f_path):
+    source = os.path.abspath(source_f_path)
+    db = manifest()
+    with _manifest_lock:
+        row = db.execute("SELECT size, mtime_ns, inode, fingerprint, settings, target FROM manifest WHERE source = ?",
+                         (source,)).fetchone()
+    if row is None or row[4] != conversion_settings() or row[5] != target_f_path:
+        return False
+    if not os.path.exists(target_f_path):
+        return False
+    st = os.stat(source)
+    if row[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+        return True
+    # File was touched, copied or moved: compare content before converting again
+    if row[0] != st.st_size or row[3] != file_fingerprint(source, st.st_size):
+        return False
+    with _manifest_lock:
+        db.execute("UPDATE manifest SET mtime_ns = ?, inode = ? WHERE source = ?", (st.st_mtime_ns, st.st_ino, source))
+        db.commit()
+    return True
 
-def get_subtitle_codec(info):
-    streams = info["streams"]
-    for s in streams:
-        if s["codec_type"] == "subtitle":
-            return s["codec_name"]
+def manifest_record(source_f_path, target_f_path):
+    source = os.path.abspath(source_f_path)
+    st = os.stat(source)
+    fingerprint = file_fingerprint(source, st.st_size)
+    db = manifest()
+    with _manifest_lock:
+        db.execute("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                   (source, st.st_size, st.st_mtime_ns, st.st_ino, fingerprint,
+                    conversion_settings(), target_f_path, time.time()))
+        db.commit()
+
+def _to_int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
 
-def ffmpeg(*args):
+def _to_float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+# Frame rates are reported as fractions like "24000/1001"
+def _to_rate(value):
+    num, _, den = str(value or "0").partition("/")
+    if _to_float(den, 1.0) == 0:
+        return 0.0
+    return _to_float(num) / _to_float(den, 1.0)
+
+# A single stream from the ffprobe results
+class StreamInfo:
+    __slots__ = ("index", "codec_type", "codec_name", "codec_tag", "profile", "pix_fmt", "width", "height",
+                 "has_b_frames", "frame_rate", "bit_rate", "channels", "language", "title",
+                 "default", "forced", "attached_pic")
+
+    def __init__(self, s):
+        tags = s.get("tags", {})
+        disposition = s.get("disposition", {})
+        self.index = _to_int(s.get("index"))
+        self.codec_type = s.get("codec_type", "")
+        self.codec_name = s.get("codec_name", "")
+        self.codec_tag = s.get("codec_tag_string", "")
+        self.profile = s.get("profile", "")
+        self.pix_fmt = s.get("pix_fmt", "")
+        self.width = _to_int(s.get("width"))
+        self.height = _to_int(s.get("height"))
+        self.has_b_frames = _to_int(s.get("has_b_frames"))
+        self.frame_rate = _to_rate(s.get("avg_frame_rate"))
+        self.bit_rate = _to_int(s.get("bit_rate"))
+        self.channels = _to_int(s.get("channels"))
+        self.language = tags.get("language", "und")
+        self.title = tags.get("title", "")
+        self.default = bool(disposition.get("default"))
+        self.forced = bool(disposition.get("forced"))
+        self.attached_pic = bool(disposition.get("attached_pic"))
+
+    def __repr__(self):
+        return "StreamInfo(%s:%s %s %s)" % (self.index, self.codec_type, self.codec_name, self.language)
+
+# Chapters of a media file, start and end times (seconds) are kept in arrays sorted by start
+class Chapters:
+    __slots__ = ("starts", "ends", "titles")
+
+    def __init__(self, chapters=()):
+        chapters = sorted(
+            (_to_float(c.get("start_time")), _to_float(c.get("end_time")), c.get("tags", {}).get("title", ""))
+            for c in chapters)
+        self.starts = array("d", (c[0] for c in chapters))
+        self.ends = array("d", (c[1] for c in chapters))
+        self.titles = tuple(c[2] for c in chapters)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        return (self.starts[i], self.ends[i], self.titles[i])
+
+    def __iter__(self):
+        return zip(self.starts, self.ends, self.titles)
+
+    def __repr__(self):
+        return "Chapters(%s)" % len(self)
+
+    # Index of the chapter playing at a timestamp (seconds), None when outside all chapters
+    def index_at(self, t):
+        i = bisect.bisect_right(self.starts, t) - 1
+        if i < 0 or t >= self.ends[i]:
+            return None
+        return i
+
+    def at(self, t):
+        i = self.index_at(t)
+        return None if i is None else self[i]
+
+    # Chapter markers (milliseconds) as used by the chapter algorithms and FFMETADATA
+    def markers(self):
+        return [{"start": int(start * 1000), "end": int(end * 1000), "title": title} for start, end, title in self]
+
+# Parsed ffprobe results, streams are indexed by type and language once per probe
+class MediaInfo:
+    __slots__ = ("filename", "format_name", "duration", "size", "bit_rate", "tags",
+                 "streams", "chapters", "_by_type", "_by_language")
+
+    def __init__(self, results):
+        fmt = results.get("format", {})
+        self.filename = fmt.get("filename", "")
+        self.format_name = fmt.get("format_name", "")
+        self.duration = _to_float(fmt.get("duration"))
+        self.size = _to_int(fmt.get("size"))
+        self.bit_rate = _to_int(fmt.get("bit_rate"))
+        self.tags = fmt.get("tags", {})
+        self.streams = tuple(StreamInfo(s) for s in results.get("streams", []))
+        self.chapters = Chapters(results.get("chapters", []))
+        by_type = {}
+        by_language = {}
+        for s in self.streams:
+            by_type.setdefault(s.codec_type, []).append(s)
+            by_language.setdefault((s.codec_type, s.language), []).append(s)
+        self._by_type = {k: tuple(v) for k, v in by_type.items()}
+        self._by_language = {k: tuple(v) for k, v in by_language.items()}
+
+    # All streams of a type ("video", "audio", "subtitle", ...)
+    def streams_of(self, codec_type):
+        return self._by_type.get(codec_type, ())
+
+    # Streams of a type in a language ("eng", "ger", "und", ...)
+    def streams_in(self, codec_type, language):
+        return self._by_language.get((codec_type, language), ())
+
+    # First video stream, cover art is ignored
+    @property
+    def video(self):
+        for s in self.streams_of("video"):
+            if not s.attached_pic:
+                return s
+        return None
+
+    @property
+    def video_codec(self):
+        return self.video.codec_name if self.video else ""
+
+    @property
+    def width(self):
+        return self.video.width if self.video else 0
+
+    @property
+    def height(self):
+        return self.video.height if self.video else 0
+
+    @property
+    def audio_codec(self):
+        streams = self.streams_of("audio")
+        return streams[0].codec_name if streams else ""
+
+    @property
+    def subtitle_codec(self):
+        streams = self.streams_of("subtitle")
+        return streams[0].codec_name if streams else ""
+
+def probe_media(filepath):
+    results = ffprobe(filepath)
+    if results == {}:
+        return None
+    return MediaInfo(results)
+
+def ffmpeg(*args, span=None):
     command = ["ffmpeg", "-hide_banner", "-nostdin", "-n"]
 
     command.extend(args)
-    try:
-        process = subprocess.run(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            check=True,
+    returncode, output = run_child(command, span, subprocess.STDOUT)
+    if returncode != 0:
+        raise RuntimeError(
+            "command '{}' return with error (code {}): {}".format(
+                command, returncode, output
+            )
         )
-        return process.stdout
-    except subprocess.CalledProcessError as e:
+    return output
+
+# Progress reported by ffmpeg with `-progress pipe:1`
+class ProgressEvent:
+    __slots__ = ("frame", "fps", "out_time", "speed", "bitrate", "total_size", "progress",
+                 "elapsed", "stalled_for", "duration")
+
+    def __init__(self, values, elapsed, stalled_for, duration):
+        self.frame = _to_int(values.get("frame"))
+        self.fps = _to_float(values.get("fps"))
+        # out_time_us is in microseconds (out_time_ms is too, despite its name)
+        self.out_time = _to_int(values.get("out_time_us", values.get("out_time_ms"))) / 1000000
+        self.speed = _to_float(values.get("speed", "").rstrip("x"))
+        self.bitrate = _to_float(values.get("bitrate", "").replace("kbits/s", "")) # kbit/s
+        self.total_size = _to_int(values.get("total_size"))
+        self.progress = values.get("progress", "")
+        self.elapsed = elapsed # wall time since ffmpeg started
+        self.stalled_for = stalled_for # wall time since out_time last moved forward
+        self.duration = duration # expected output duration, 0 if unknown
+
+    @property
+    def percent(self):
+        if self.duration <= 0:
+            return 0.0
+        return min(100.0, 100.0 * self.out_time / self.duration)
+
+    # Estimated seconds until the encode finishes, None if unknown
+    @property
+    def eta(self):
+        if self.duration <= 0 or self.out_time <= 0:
+            return None
+        return max(0.0, (self.duration - self.out_time) * self.elapsed / self.out_time)
+
+    def __repr__(self):
+        return "ProgressEvent(frame=%s fps=%s out_time=%.2f speed=%sx)" % (self.frame, self.fps, self.out_time, self.speed)
+
+# Run ffmpeg and yield a ProgressEvent for every progress report
+# Raises RuntimeError with the last lines of ffmpeg's output when it fails
+def ffmpeg_progress(*args, duration=0.0, span=None):
+    command = ["ffmpeg", "-hide_banner", "-nostdin", "-n", "-nostats", "-progress", "pipe:1"]
+    command.extend(args)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    # Keep the tail of stderr for error messages, without blocking ffmpeg
+    errors = deque(maxlen=20)
+    reader = threading.Thread(target=errors.extend, args=(process.stderr,), daemon=True)
+    reader.start()
+
+    start = time.time()
+    last_advance = start
+    last_out_time = -1
+    values = {}
+    finished = False
+    try:
+        for line in process.stdout:
+            key, _, value = line.strip().partition("=")
+            values[key] = value
+            if key != "progress":
+                continue
+            now = time.time()
+            event = ProgressEvent(values, now - start, 0.0, duration)
+            if event.out_time > last_out_time:
+                last_out_time = event.out_time
+                last_advance = now
+            event.stalled_for = now - last_advance
+            values = {}
+            yield event
+        finished = True
+    finally:
+        if not finished:
+            # Consumer stopped early
+            process.kill()
+        wait_child(process, span)
+        reader.join()
+    if process.returncode != 0:
         raise RuntimeError(
             "command '{}' return with error (code {}): {}".format(
-                e.cmd, e.returncode, e.output
+                command, process.returncode, "".join(errors)
             )
         )
 
-def ffmpeg_ffmetadata(filepath):
-    # map_chapters parameter ensures we ignore any existing chapter definitions
-    # TODO: consider using /dev/stdout as filename: ffmpeg -i media/GOT_chapters.mkv -y -f ffmetadata /dev/stdout
-    args = ["-i", filepath, "-map_chapters", "-1", "-f", "ffmetadata", FFMETADATA_FILE]
-    result = ffmpeg(*args)
-    return result
+# Run ffmpeg, pass every progress event to the callback and return the last one
+def ffmpeg_run(*args, duration=0.0, callback=None, span=None):
+    event = None
+    for event in ffmpeg_progress(*args, duration=duration, span=span):
+        if callback:
+            callback(event)
+    return event
+
+# Single line progress display for interactive runs
+def print_progress(event):
+    eta = time.strftime("%H:%M:%S", time.gmtime(event.eta)) if event.eta is not None else "--:--:--"
+    line = "    ... %5.1f%% frame=%s fps=%s speed=%sx size=%s MB eta %s" % (
+        event.percent, event.frame, event.fps, event.speed, round(event.total_size / 1024**2, 1), eta)
+    end = "\n" if event.progress == "end" else ""
+    print("\r" + line, end=end, flush=True)
 
 def ffmpeg_dispositions():
     args = ["-dispositions"]
@@ -265,13 +784,416 @@ def ffmpeg_decoder_details(decoder: str):
     result = ffmpeg(*args)
     return result
 
-def ffmpeg_simulate(filepath):
-    args = ["-i", filepath, "-t", "00:00:01", "-f", "null", "-"]
+# Rows of an ffmpeg listing (-codecs, -encoders, -decoders, -formats) as (flags, name, description)
+# The flag columns are as wide as the dashes of the separator line that ends the legend
+def ffmpeg_listing(output):
+    width = None
+    for line in output.splitlines():
+        if width is None:
+            if line.strip() and set(line.strip()) == {"-"}:
+                width = len(line.strip())
+            continue
+        if len(line) <= width + 1:
+            continue
+        fields = line[width + 1:].split(None, 1)
+        if fields:
+            yield line[1:width + 1], fields[0], fields[1].strip() if len(fields) > 1 else ""
+
+FFMPEG_MEDIA_TYPES = {"V": "video", "A": "audio", "S": "subtitle", "D": "data", "T": "attachment"}
+
+# Parse the ffmpeg listings into plain data that can be stored as JSON
+def ffmpeg_capability_data():
+    data = {"codecs": {}, "encoders": {}, "decoders": {}, "demuxers": [], "muxers": [], "dispositions": []}
+    for flags, name, description in ffmpeg_listing(ffmpeg_codecs()):
+        # D..... decoding, .E.... encoding, ..V... type, ...I.. intra only, ....L. lossy, .....S lossless
+        coders = dict(re.findall(r"\((decoders|encoders): ([^)]*)\)", description))
+        data["codecs"][name] = {
+            "type": FFMPEG_MEDIA_TYPES.get(flags[2:3], "unknown"),
+            "decode": flags[0:1] == "D",
+            "encode": flags[1:2] == "E",
+            "intra_only": flags[3:4] == "I",
+            "lossy": flags[4:5] == "L",
+            "lossless": flags[5:6] == "S",
+            # Codecs without an explicit list have a coder of the same name
+            "decoders": coders["decoders"].split() if "decoders" in coders else [name] * (flags[0:1] == "D"),
+            "encoders": coders["encoders"].split() if "encoders" in coders else [name] * (flags[1:2] == "E"),
+            "description": re.sub(r"\s*\((decoders|encoders): [^)]*\)", "", description),
+        }
+    for kind, output in (("encoders", ffmpeg_encoders()), ("decoders", ffmpeg_decoders())):
+        for flags, name, description in ffmpeg_listing(output):
+            # V..... type, .F.... frame threads, ..S... slice threads, ...X.. experimental
+            data[kind][name] = {
+                "type": FFMPEG_MEDIA_TYPES.get(flags[0:1], "unknown"),
+                "frame_threads": flags[1:2] == "F",
+                "slice_threads": flags[2:3] == "S",
+                "experimental": flags[3:4] == "X",
+                "draw_horiz_band": flags[4:5] == "B",
+                "direct_rendering": flags[5:6] == "D",
+                "description": description,
+            }
+    for flags, names, description in ffmpeg_listing(ffmpeg_formats()):
+        # D. demuxing, .E muxing, a format can have several comma separated names
+        if flags[0:1] == "D":
+            data["demuxers"].extend(names.split(","))
+        if flags[1:2] == "E":
+            data["muxers"].extend(names.split(","))
+    for line in ffmpeg_dispositions().splitlines():
+        if re.fullmatch(r"[a-z_]+", line.strip()):
+            data["dispositions"].append(line.strip())
+    return data
+
+# Codec, encoder or decoder known to ffmpeg, built from the parsed listing
+class FFmpegCodec:
+    __slots__ = ("name", "codec_type", "decode", "encode", "intra_only", "lossy", "lossless",
+                 "decoders", "encoders", "description")
+
+    def __init__(self, name, values):
+        self.name = name
+        self.codec_type = values["type"]
+        self.decode = values["decode"]
+        self.encode = values["encode"]
+        self.intra_only = values["intra_only"]
+        self.lossy = values["lossy"]
+        self.lossless = values["lossless"]
+        self.decoders = tuple(values["decoders"])
+        self.encoders = tuple(values["encoders"])
+        self.description = values["description"]
+
+    def __repr__(self):
+        return "FFmpegCodec(%s %s)" % (self.name, self.codec_type)
+
+class FFmpegCoder:
+    __slots__ = ("name", "codec_type", "frame_threads", "slice_threads", "experimental",
+                 "draw_horiz_band", "direct_rendering", "description")
+
+    def __init__(self, name, values):
+        self.name = name
+        self.codec_type = values["type"]
+        self.frame_threads = values["frame_threads"]
+        self.slice_threads = values["slice_threads"]
+        self.experimental = values["experimental"]
+        self.draw_horiz_band = values["draw_horiz_band"]
+        self.direct_rendering = values["direct_rendering"]
+        self.description = values["description"]
+
+    def __repr__(self):
+        return "FFmpegCoder(%s %s)" % (self.name, self.codec_type)
+
+# What the installed ffmpeg binary can decode, encode, demux and mux
+class FFmpegCapabilities:
+    def __init__(self, data):
+        self.codecs = {name: FFmpegCodec(name, values) for name, values in data["codecs"].items()}
+        self.encoders = {name: FFmpegCoder(name, values) for name, values in data["encoders"].items()}
+        self.decoders = {name: FFmpegCoder(name, values) for name, values in data["decoders"].items()}
+        self.demuxers = frozenset(data["demuxers"])
+        self.muxers = frozenset(data["muxers"])
+        self.dispositions = frozenset(data["dispositions"])
+
+    # Encoder ffmpeg uses for `-c <name>`, which is either an encoder or a codec name
+    def encoder_for(self, name):
+        if name in self.encoders:
+            return self.encoders[name]
+        codec = self.codecs.get(name)
+        if codec:
+            for encoder in codec.encoders:
+                if encoder in self.encoders:
+                    return self.encoders[encoder]
+        return None
+
+    def decoder_for(self, codec_name):
+        codec = self.codecs.get(codec_name)
+        if codec:
+            for decoder in codec.decoders:
+                if decoder in self.decoders:
+                    return self.decoders[decoder]
+        return self.decoders.get(codec_name)
+
+    def can_encode(self, name):
+        return self.encoder_for(name) is not None
+
+    def can_decode(self, codec_name):
+        return self.decoder_for(codec_name) is not None
+
+# Capabilities of the ffmpeg on the PATH, parsed once per binary
+# The parsed listings are cached on disk keyed by the binary's path and modification time
+_ffmpeg_capabilities = None
+_ffmpeg_capabilities_lock = threading.Lock()
+
+def ffmpeg_capabilities():
+    global _ffmpeg_capabilities
+    with _ffmpeg_capabilities_lock:
+        if _ffmpeg_capabilities is None:
+            binary = shutil.which("ffmpeg")
+            if binary is None:
+                raise RuntimeError("ffmpeg not found on the PATH")
+            binary = os.path.realpath(binary)
+            key = {"binary": binary, "mtime_ns": os.stat(binary).st_mtime_ns}
+            cache_path = os.path.expanduser(arg_ffmpeg_capabilities) if arg_ffmpeg_capabilities else None
+            data = None
+            if cache_path:
+                try:
+                    with open(cache_path) as f:
+                        cached = json.load(f)
+                    if cached.get("key") == key:
+                        data = cached["capabilities"]
+                except (OSError, ValueError, KeyError):
+                    pass
+            if data is None:
+                # The listings are not part of the probe or plan span that happens to ask first
+                with Span("capabilities"):
+                    data = ffmpeg_capability_data()
+                if cache_path:
+                    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                    temp_path = "%s.%s" % (cache_path, os.getpid())
+                    with open(temp_path, "w") as f:
+                        json.dump({"key": key, "capabilities": data}, f)
+                    os.replace(temp_path, cache_path)
+            _ffmpeg_capabilities = FFmpegCapabilities(data)
+        return _ffmpeg_capabilities
+
+# Decode the first packets of the video stream
+def ffmpeg_simulate(filepath, packets):
+    args = ["-i", filepath, "-map", "0:v:0", "-frames:v", str(packets), "-f", "null", "-"]
     result = ffmpeg(*args)
     return result
 
-def ffmpeg_convert(source_f_path, target_f_path, fprobe_results):
+# Decision for a single source stream: copy, transcode or drop
+class StreamPlan:
+    __slots__ = ("stream", "action", "codec", "reason", "bsf")
+
+    def __init__(self, stream, action, codec=None, reason="", bsf=None):
+        self.stream = stream
+        self.action = action
+        self.codec = codec
+        self.reason = reason
+        self.bsf = bsf # bitstream filter applied while copying
+
+    def __repr__(self):
+        return "StreamPlan(%s:%s %s %s)" % (self.stream.index, self.stream.codec_type, self.action, self.codec or "")
+
+# Check if the video needs to be scaled to 1080p
+# https://write.corbpie.com/a-guide-to-upscaling-or-downscaling-video-with-ffmpeg/
+def scaling_enabled(info):
+    if arg_upscaling and info.height < 1080:
+        return True
+    if arg_downscaling and info.height > 1080:
+        return True
+    return False
+
+# Decide for every stream if it can be copied, must be transcoded or has to be dropped
+# Streams ffmpeg can not decode are dropped, they could only be copied
+def plan_streams(info):
+    plans = []
+    scaling = scaling_enabled(info)
+    capabilities = ffmpeg_capabilities()
+    for s in info.streams:
+        if s.codec_type == "video":
+            if s.attached_pic:
+                plans.append(StreamPlan(s, "drop", reason="cover art"))
+            elif scaling:
+                # Filtering and streamcopy cannot be used together
+                plans.append(StreamPlan(s, "transcode", target_video_codec, "scaling"))
+            elif s.codec_name not in target_copy_codecs["video"]:
+                plans.append(StreamPlan(s, "transcode", target_video_codec, "codec not supported by target"))
+            elif s.pix_fmt and s.pix_fmt not in target_video_pix_fmts:
+                plans.append(StreamPlan(s, "transcode", target_video_codec, "pixel format not supported by target"))
+            elif s is info.video and packed_b_frames(info):
+                # The decoder unpacks them when transcoding, a copy needs the bitstream filter
+                plans.append(StreamPlan(s, "copy", reason="packed b-frames", bsf="mpeg4_unpack_bframes"))
+            else:
+                plans.append(StreamPlan(s, "copy"))
+        elif s.codec_type == "audio":
+            if s.codec_name in target_copy_codecs["audio"]:
+                plans.append(StreamPlan(s, "copy"))
+            elif not capabilities.can_decode(s.codec_name):
+                plans.append(StreamPlan(s, "drop", reason="no %s decoder in ffmpeg" % s.codec_name))
+            else:
+                plans.append(StreamPlan(s, "transcode", target_audio_codec, "codec not supported by target"))
+        elif s.codec_type == "subtitle":
+            if arg_subtitles == "remove":
+                plans.append(StreamPlan(s, "drop", reason="subtitles removed"))
+            elif s.codec_name in target_copy_codecs["subtitle"]:
+                plans.append(StreamPlan(s, "copy"))
+            elif s.codec_name in text_subtitle_codecs and not capabilities.can_decode(s.codec_name):
+                plans.append(StreamPlan(s, "drop", reason="no %s decoder in ffmpeg" % s.codec_name))
+            elif s.codec_name in text_subtitle_codecs:
+                plans.append(StreamPlan(s, "transcode", target_subtitle_codec, "codec not supported by target"))
+            else:
+                # Subtitle encoding is only possible from text to text or bitmap to bitmap
+                plans.append(StreamPlan(s, "drop", reason="bitmap subtitles can not be converted to text"))
+        elif s.codec_type == "attachment" and target_container == "mkv":
+            plans.append(StreamPlan(s, "copy"))
+        else:
+            plans.append(StreamPlan(s, "drop", reason="stream type not supported by target"))
+    return plans
+
+def print_stream_plans(plans):
+    for plan in plans:
+        s = plan.stream
+        decision = plan.action + (" " + plan.codec if plan.codec else "")
+        reason = " (%s)" % plan.reason if plan.reason else ""
+        print("    ... stream %s %s %s [%s] -> %s%s" % (s.index, s.codec_type, s.codec_name, s.language, decision, reason))
+
+# ffmpeg arguments mapping and encoding the planned streams of an input
+def stream_args(plans, input_index=0):
+    args = []
+    specifiers = {"video": "v", "audio": "a", "subtitle": "s", "attachment": "t"}
+    counters = {}
+    for plan in plans:
+        if plan.action == "drop":
+            continue
+        spec = specifiers[plan.stream.codec_type]
+        n = counters.get(spec, 0)
+        counters[spec] = n + 1
+        args.extend(["-map", "%s:%s" % (input_index, plan.stream.index)])
+        args.extend(codec_args(plan, spec, n))
+    return args
+
+# ffmpeg codec arguments for the n-th output stream of a type
+def codec_args(plan, spec, n):
+    if plan.action == "copy":
+        args = ["-c:%s:%s" % (spec, n), "copy"]
+        if plan.bsf:
+            args.extend(["-bsf:%s:%s" % (spec, n), plan.bsf])
+        return args
+    args = ["-c:%s:%s" % (spec, n), plan.codec]
+    encoder = ffmpeg_capabilities().encoder_for(plan.codec)
+    if encoder and encoder.experimental:
+        args.extend(["-strict:%s:%s" % (spec, n), "experimental"])
+    if spec == "v":
+        args.extend(["-crf:v:%s" % n, target_video_quality])
+        if encoder_profile().get("preset"):
+            args.extend(["-preset:v:%s" % n, encoder_profile()["preset"]])
+        if plan.reason == "scaling":
+            args.extend(["-filter:v:%s" % n, "scale=-1:1080:flags=lanczos"])
+        if plan.stream.pix_fmt not in target_video_pix_fmts:
+            args.extend(["-pix_fmt:v:%s" % n, "yuv420p"])
+    return args
+
+# Encoder settings measured by the benchmark command
+_encoder_profile = None
+
+def encoder_profile():
+    global _encoder_profile
+    if _encoder_profile is None:
+        try:
+            with open(os.path.expanduser(target_encoder_profile)) as f:
+                _encoder_profile = json.load(f)
+        except (OSError, ValueError):
+            _encoder_profile = {}
+    return _encoder_profile
+
+# Number of parallel conversion jobs
+def encoder_jobs():
+    if arg_jobs:
+        return arg_jobs
+    return encoder_profile().get("jobs", 1)
+
+# Predict the size of the converted file from the probe and the stream plan
+# Transcoded video is estimated from the bits per pixel x264 typically needs at CRF 21,
+# halving for every 6 CRF steps, and is never assumed to be more than 10% above the source
+PREDICT_BITS_PER_PIXEL = 0.1
+PREDICT_AUDIO_BITRATE = 64000 # per channel for transcoded audio
+PREDICT_MUX_OVERHEAD = 1.02
+
+# Width and height of a planned video stream after scaling
+def planned_dimensions(plan):
+    s = plan.stream
+    height = 1080 if plan.reason == "scaling" else s.height
+    width = s.width * height // s.height if s.height else s.width
+    return width, height
+
+def predict_output_size(info, plans):
+    if info.duration <= 0:
+        return info.size
+    # Bit rate of streams without one, derived from the container
+    known = sum(s.bit_rate for s in info.streams)
+    unknown = [s for s in info.streams if not s.bit_rate and s.codec_type in ("video", "audio")]
+    leftover = max(0, info.bit_rate - known) // max(1, len(unknown))
+    bit_rate = 0
+    for plan in plans:
+        s = plan.stream
+        source_rate = s.bit_rate or leftover
+        if plan.action == "drop" or s.codec_type not in ("video", "audio"):
+            continue
+        if plan.action == "copy":
+            bit_rate += source_rate
+        elif s.codec_type == "video":
+            width, height = planned_dimensions(plan)
+            bpp = PREDICT_BITS_PER_PIXEL * 2 ** ((21 - _to_float(target_video_quality, 21)) / 6)
+            rate = width * height * (s.frame_rate or 25) * bpp
+            if source_rate and plan.reason != "scaling":
+                rate = min(rate, source_rate * 1.1)
+            bit_rate += rate
+        else:
+            bit_rate += PREDICT_AUDIO_BITRATE * max(1, min(s.channels, 6))
+    return int(bit_rate * info.duration / 8 * PREDICT_MUX_OVERHEAD)
+
+# Predict the seconds a single job needs to encode the file from the frames per second the
+# benchmark measured, scaled by the pixels per frame. None without an encoder profile
+def predict_encode_seconds(info, plans):
+    profile = encoder_profile()
+    if not profile.get("job_fps") or not profile.get("pixels"):
+        return None
+    seconds = 0.0
+    for plan in plans:
+        s = plan.stream
+        if plan.action != "transcode" or s.codec_type != "video":
+            continue
+        width, height = planned_dimensions(plan)
+        fps = profile["job_fps"] * profile["pixels"] / max(1, width * height)
+        seconds += info.duration * (s.frame_rate or 25) / fps
+    return round(seconds, 1)
+
+# Free space on the target filesystem shared by the running conversions
+# Each running job reserves its predicted size minus what it has written so far
+class SpaceBudget:
+    def __init__(self, path, reserve=0):
+        path = os.path.abspath(os.path.expanduser(path))
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        self.path = path
+        self.reserve_bytes = reserve
+        self.running = {}
+        self.lock = threading.Lock()
+
+    def free(self):
+        st = os.statvfs(self.path)
+        return st.f_bavail * st.f_frsize
+
+    # Bytes the running jobs are still expected to write, encodes write to the partial file of their target
+    def outstanding(self):
+        total = 0
+        for target, size in self.running.items():
+            partial_f_path = partial_path(target)
+            written = os.path.getsize(partial_f_path) if os.path.exists(partial_f_path) else 0
+            total += max(0, size - written)
+        return total
+
+    def reserve(self, target, size):
+        with self.lock:
+            if self.free() - self.reserve_bytes - self.outstanding() < size:
+                return False
+            self.running[target] = size
+            return True
+
+    def release(self, target):
+        with self.lock:
+            self.running.pop(target, None)
+
+# Split the ffmpeg thread budget evenly across parallel jobs
+def job_threads(jobs):
+    profile = encoder_profile()
+    if profile.get("jobs") == jobs and "threads" in profile:
+        return profile["threads"]
+    if jobs <= 1:
+        return 0 # let ffmpeg decide
+    return max(1, arg_threads // jobs)
+
+# The target is written to `output_f_path` when given, the caller moves it in place
+def ffmpeg_convert(source_f_path, target_f_path, info, threads=0, progress=None, output_f_path=None):
     item = {}
+    output_f_path = output_f_path or target_f_path
 
     #TODO: Generate the order of the audio map parameters by leveraging `target_primary_language`
     # https://askubuntu.com/a/1329506
@@ -313,309 +1235,1319 @@ def ffmpeg_convert(source_f_path, target_f_path, fprobe_results):
     args = ["-i", source_f_path]
 
     # SOURCE - VIDEO STREAMS
-    item["source_video_codec"] = get_video_codec(fprobe_results)
+    item["source_video_codec"] = info.video_codec
     print("    ... video codec = %s" % item["source_video_codec"])
-    item["source_video_duration"] = get_video_duration(fprobe_results)
-    item["source_video_streams"] = get_video_stream_count(fprobe_results)
-    #item["source_bframes"] = packed_b_frames(input_file=f_path, convert=False)
-    item["source_video_width"] = get_video_width(fprobe_results)
-    item["source_video_height"] = get_video_height(fprobe_results)
+    item["source_video_duration"] = info.duration
+    item["source_video_streams"] = len(info.streams_of("video"))
+    item["source_video_width"] = info.width
+    item["source_video_height"] = info.height
     print("    ... video width = %s" % item["source_video_width"])
     print("    ... video height = %s" % item["source_video_height"])
 
     # SOURCE - AUDIO STREAMS
-    item["source_audio_streams"] = get_audio_stream_count(fprobe_results)
+    item["source_audio_streams"] = len(info.streams_of("audio"))
     print("    ... audio streams found = %s" % item["source_audio_streams"])
 
     # SOURCE - SUBTITLE STREAMS
-    item["source_subtitle_streams"] = get_subtitle_stream_count(fprobe_results)
+    item["source_subtitle_streams"] = len(info.streams_of("subtitle"))
     print("    ... subtitle streams found = %s" % item["source_subtitle_streams"])
 
     # SOURCE - CHAPTERS
-    item["source_chapters"] = get_chapter_count(fprobe_results)
+    item["source_chapters"] = len(info.chapters)
     print("    ... chapters found = %s" % item["source_chapters"])
 
     # TARGET
     print("Target: '%s'" % target_f_path)
 
-    # TARGET - DEFAULT PASSTHROUGH BEHAVIOR
-    args.extend(["-c", "copy"])
-
-    # TARGET - VIDEO STREAMS
-    # https://write.corbpie.com/a-guide-to-upscaling-or-downscaling-video-with-ffmpeg/
-    target_scaling_enabled = False
-    if arg_upscaling and item['source_video_height'] < 1080:
-        target_scaling_enabled = True
-    if arg_downscaling and item['source_video_height'] > 1080:
-        target_scaling_enabled = True
-    print("    ... target scaling enabled: %s" % target_scaling_enabled)
-    if target_scaling_enabled:
-        # Force encoding when upscaling is enabled, otherwise we get the following error:
-        # Filtering and streamcopy cannot be used together.
-        args.extend(["-c:v", target_video_codec, "-crf", target_video_quality])
-        args.extend(["-vf", "scale=-1:1080:flags=lanczos"])
-    elif item["source_video_codec"] != target_video_codec:
-        # Force encoding if source video codec is not the same as target codec
-        args.extend(["-c:v", target_video_codec, "-crf", target_video_quality])
-
-    # TARGET - AUDIO STREAMS
-    # TODO: Determine if audio streams need to be encoded to target codec or not
-    args.extend(["-c:a", "aac"])
-
-    # TARGET - SUBTITLE STREAMS
-    # TODO: Determine if subtitle streams need to be encoded to target codec or not
-    args.extend(["-c:s", "srt"])
+    # TARGET - STREAMS
+    # Every stream is copied when the target supports it, otherwise transcoded or dropped
+    with Span("plan", source_f_path):
+        plans = plan_streams(info)
+    print_stream_plans(plans)
+    item["target_streams"] = [(plan.stream.index, plan.stream.codec_type, plan.action) for plan in plans]
+    item["target_remux_only"] = all(plan.action != "transcode" for plan in plans)
+    item["source_packed_b_frames"] = any(plan.bsf == "mpeg4_unpack_bframes" for plan in plans)
+    print("    ... target scaling enabled: %s" % scaling_enabled(info))
+    missing = sorted({plan.codec for plan in plans
+                      if plan.action == "transcode" and not ffmpeg_capabilities().can_encode(plan.codec)})
+    if missing:
+        print_error("    ... ERROR, ffmpeg has no encoder for %s" % ", ".join(missing))
+        item["status"] = "failed"
+        return item
+
+    # TARGET - PASSTHROUGH
+    # Sources that would be remuxed without any change are linked or moved instead of rewritten
+    if passthrough_possible(source_f_path, target_f_path, info, plans):
+        if not arg_convert:
+            print("    ... target would be linked to the source (%s)" % arg_passthrough)
+            item["target_passthrough"] = arg_passthrough
+            return item
+        with Span("copy", source_f_path):
+            method = passthrough_target(source_f_path, output_f_path)
+        if method:
+            print("    ... target %s from the source, nothing to convert" % method)
+            item["target_passthrough"] = method
+            item["status"] = "converted"
+            return item
+        print_dim("    ... unable to link the target, remuxing instead")
+    args.extend(stream_args(plans))
     # TODO: ffmpeg - detect local subtitles files to include with container
     # https://gist.github.com/kurlov/32cbe841ea9d2b299e15297e54ae8971
-    # TODO: Handle subtitle errors when some subtitle streams are already 'srt' (codec_name = subrip) and some are not
-    # error:
-    # ffmpeg -i 'media/GOT_error.mkv'
-    #   -c:v copy -map 0:v:0 -c:a aac -map 0:m:language:eng? -disposition:a:0 default 
-    #   -c:s srt /Users/johnw/Movies/_CONVERT_/GOT_S05E01.mkv
-    # Error initializing output stream 0:4 -- Subtitle encoding currently only possible from text to text or bitmap to bitmap
-    # Stream mapping:
-    #   Stream #0:0 -> #0:0 (copy)
-    #   Stream #0:2 -> #0:1 (ac3 (native) -> aac (native))
-    #   Stream #0:4 -> #0:2 (subrip (srt) -> subrip (srt))
-    #   Stream #0:7 -> #0:3 (subrip (srt) -> subrip (srt))
-    #   Stream #0:8 -> #0:4 (hdmv_pgs_subtitle (pgssub) -> subrip (srt))
-    #     Last message repeated 1 times
 
     # TARGET - CHAPTERS
-    #scenes = chapters_algorithm_scenes(item["filename"])
-    #chapters_algorithm_duration(f_path, item["source_video_duration"])
-    #if arg_verbose:
-    #    print(markers)
+    chapters_f_path = None
+    markers = []
+    if arg_chapters == "remove":
+        args.extend(["-map_chapters", "-1"])
+    elif arg_chapters == "duration" and not info.chapters and info.duration > 0:
+        markers = chapters_algorithm_duration(info.duration)
+        print("    ... %s chapters generated from duration" % len(markers))
+    elif arg_chapters == "detect-scenes" and not info.chapters and info.duration > 0:
+        if arg_convert:
+            with Span("chapters", source_f_path):
+                markers = chapters_algorithm_scenes(source_f_path, info.duration)
+            print("    ... %s chapters detected from scenes" % len(markers))
+        else:
+            print("    ... chapters will be detected from scenes")
+    if markers:
+        if arg_verbose:
+            print(markers)
+        if arg_convert:
+            # Global tags and chapters of the target come from the generated FFMETADATA document
+            chapters_f_path = write_ffmetadata(ffmetadata_document(info.tags, markers))
+            args[2:2] = ["-f", "ffmetadata", "-i", chapters_f_path]
+            args.extend(["-map_metadata", "1", "-map_chapters", "1"])
+    item["target_chapters_generated"] = chapters_f_path is not None
 
     # TARGET - THUMBNAIL?
 
-    # TARGET - OUTPUT
-    args.append(target_f_path)
-    if arg_verbose:
-        print("    ... command: ffmpeg", ' '.join(args))
-    if arg_convert:
-        # TODO: Add error handling for ffpb
-        # TODO: Capture what ffmpeg output shows on what will be the final stream structure
-        ffpb.main(args)
-        # TODO: Run ffprobe after conversion and show information and check health of video
+    try:
+        # TARGET - THREADS
+        if threads:
+            args.extend(["-threads", str(threads)])
+
+        # TARGET - SEGMENTED ENCODING OF LONG FILES
+        video_plans = [plan for plan in plans if plan.stream.codec_type == "video" and plan.action != "drop"]
+        if (arg_convert and arg_segments > 1 and info.duration >= arg_segment_min_duration
+                and len(video_plans) == 1 and video_plans[0].action == "transcode"):
+            print("    ... encoding video in %s parallel segments" % arg_segments)
+            try:
+                with Span("encode", source_f_path):
+                    ffmpeg_convert_segmented(source_f_path, output_f_path, info, plans, threads, chapters_f_path,
+                                             progress)
+                item["status"] = "converted"
+            except RuntimeError as e:
+                print_error("    ... ERROR, conversion failed for '%s'" % source_f_path)
+                print_dim(str(e))
+                item["status"] = "failed"
+            return item
+
+        # TARGET - OUTPUT
+        args.append(output_f_path)
+        if arg_verbose:
+            print("    ... command: ffmpeg", ' '.join(args))
+        if arg_convert:
+            # TODO: Capture what ffmpeg output shows on what will be the final stream structure
+            if progress is None and encoder_jobs() == 1 and sys.stdout.isatty():
+                # Progress lines of parallel jobs would overwrite each other
+                progress = print_progress
+            try:
+                with Span("encode", source_f_path):
+                    event = ffmpeg_run(*args, duration=info.duration, callback=progress)
+                item["status"] = "converted"
+                if event:
+                    item["encode_frames"] = event.frame
+                    item["encode_fps"] = round(event.frame / event.elapsed, 2) if event.elapsed else 0.0
+                    item["encode_speed"] = event.speed
+            except RuntimeError as e:
+                print_error("    ... ERROR, conversion failed for '%s'" % source_f_path)
+                print_dim(str(e))
+                item["status"] = "failed"
+    finally:
+        if chapters_f_path:
+            os.remove(chapters_f_path)
 
     return item
 
-# Check for packed b-frames in AVI files
-# Option:
-#   Do not care about b-frames. Does it matter if we convert to MP4 ?
-# Option:
-#   Maybe simply use ffprobe output `has_b_frames: 1` property of a stream with `codec_type = video`?
-#   Test this by converting a simple file and check the ffprobe output again!
+# Device of a path, or of its closest existing parent for targets that do not exist yet
+def filesystem_device(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+# True when the target would be a plain remux of a matroska source: every stream copied
+# without bitstream filters, chapters kept as they are and both on the same filesystem
+def passthrough_possible(source_f_path, target_f_path, info, plans):
+    if arg_passthrough == "off" or target_container != "mkv":
+        return False
+    if os.path.exists(target_f_path) and not arg_overwrite:
+        return False
+    if "matroska" not in info.format_name.split(",") or not source_f_path.lower().endswith(".mkv"):
+        return False
+    if any(plan.action != "copy" or plan.bsf for plan in plans):
+        return False
+    if arg_chapters == "remove" and info.chapters:
+        return False
+    if arg_chapters in ("duration", "detect-scenes") and not info.chapters and info.duration > 0:
+        return False
+    return filesystem_device(source_f_path) == filesystem_device(target_f_path)
+
+FICLONE = 0x40049409 # Linux ioctl sharing the extents of a file (btrfs, xfs)
+
+# Create the target from the source without writing its bytes, returns the method used or None
+# A reflink is preferred over a hardlink, changes to a hardlinked target also change the source
+def passthrough_target(source_f_path, target_f_path):
+    if arg_passthrough == "rename":
+        try:
+            os.rename(source_f_path, target_f_path)
+            return "renamed"
+        except OSError:
+            return None
+    if sys.platform.startswith("linux"):
+        import fcntl
+        try:
+            with open(source_f_path, "rb") as src, open(target_f_path, "xb") as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    shutil.copystat(source_f_path, target_f_path)
+                    return "reflinked"
+                except OSError:
+                    pass
+            os.remove(target_f_path)
+        except OSError:
+            return None
+    try:
+        os.link(source_f_path, target_f_path)
+        return "hardlinked"
+    except OSError:
+        return None
+
+# Timestamps of the video keyframes, read from the packet index without decoding
+def keyframe_times(filepath):
+    command = ["ffprobe", "-v", "error", "-select_streams", "v:0",
+               "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", filepath]
+    returncode, output = run_child(command, stderr=None)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    times = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ("", "N/A"):
+            times.append(float(pts_time))
+    times.sort()
+    return times
+
+# Keyframes closest to an even split of the duration into `segments` parts
+def segment_split_points(keyframes, duration, segments):
+    points = set()
+    for i in range(1, segments):
+        target = duration * i / segments
+        pos = bisect.bisect_left(keyframes, target)
+        nearby = keyframes[max(0, pos - 1):pos + 1]
+        if nearby:
+            points.add(min(nearby, key=lambda t: abs(t - target)))
+    return sorted(t for t in points if 0 < t < duration)
+
+# Encode the video of a long file as segments in parallel
+# 1. split the video stream at keyframes (stream copy)
+# 2. encode every segment at the same time
+# 3. concatenate the encoded segments and mux them with the audio, subtitles and chapters of the source
+# Every stage passes its progress events to the callback, which can stop the conversion by raising
+def ffmpeg_convert_segmented(source_f_path, target_f_path, info, plans, threads=0, chapters_f_path=None,
+                             progress=None):
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    video_plan = [plan for plan in plans if plan.stream.codec_type == "video" and plan.action != "drop"][0]
+    other_plans = [plan for plan in plans if plan is not video_plan]
+    points = segment_split_points(keyframe_times(source_f_path), info.duration, arg_segments)
+    segment_threads = max(1, (threads or arg_threads) // (len(points) + 1))
+
+    temp_dir = tempfile.mkdtemp(prefix="segments-", dir=target_temp_dir)
+    try:
+        # Split
+        split_args = ["-i", source_f_path, "-map", "0:%s" % video_plan.stream.index, "-c", "copy"]
+        if points:
+            split_args.extend(["-f", "segment", "-segment_times", ",".join("%.6f" % t for t in points),
+                               "-reset_timestamps", "1", os.path.join(temp_dir, "source-%03d.mkv")])
+        else:
+            split_args.append(os.path.join(temp_dir, "source-000.mkv"))
+        ffmpeg_run(*split_args, callback=progress)
+        sources = sorted(f for f in os.listdir(temp_dir) if f.startswith("source-"))
+        print("    ... split video into %s segments at %s" % (len(sources), ", ".join("%.2f" % t for t in points)))
+
+        # Encode, the segments count towards the span of this conversion
+        span = current_span()
+        def encode(name):
+            output = os.path.join(temp_dir, name.replace("source-", "encoded-"))
+            ffmpeg_run("-i", os.path.join(temp_dir, name), "-map", "0:v:0", *codec_args(video_plan, "v", 0),
+                       "-threads", str(segment_threads), output, callback=progress, span=span)
+            return output
+        with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+            encoded = list(pool.map(encode, sources))
+
+        # Concatenate and mux
+        concat_f_path = os.path.join(temp_dir, "concat.txt")
+        with open(concat_f_path, "w") as f:
+            for output in encoded:
+                f.write("file '%s'\n" % output.replace("'", "'\\''"))
+        args = ["-f", "concat", "-safe", "0", "-i", concat_f_path, "-i", source_f_path,
+                "-map", "0:v:0", "-c:v:0", "copy"]
+        # Any other video stream is dropped, so only audio, subtitles and attachments follow
+        args.extend(stream_args(other_plans, input_index=1))
+        if chapters_f_path:
+            args[8:8] = ["-f", "ffmetadata", "-i", chapters_f_path]
+            args.extend(["-map_metadata", "2", "-map_chapters", "2"])
+        else:
+            args.extend(["-map_metadata", "1", "-map_chapters", "-1" if arg_chapters == "remove" else "1"])
+        args.append(target_f_path)
+        if arg_verbose:
+            print("    ... command: ffmpeg", ' '.join(args))
+        ffmpeg_run(*args, callback=progress)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+# Check for packed b-frames in MPEG-4 Part 2 (DivX/XviD) video
 # Error:
 #   "Video uses a non-standard and wasteful way to store B-frames ('packed B-frames'). Consider using the mpeg4_unpack_bframes bitstream filter without encoding but stream copy to fix it."
-# Remove:
+# The probe rules out most files: only mpeg4 video with b-frames from DivX/XviD style encoders
+# can have packed b-frames, for those a bounded number of packets is decoded to confirm.
+# Fix:
 #   https://superuser.com/questions/782634/ffmpeg-avidemux-fix-packed-b-frames
 #   ffmpeg -i "input.avi" -codec copy -bsf:v mpeg4_unpack_bframes "input2.avi"
-def packed_b_frames(input_file, convert=False, output_file="temp.avi"):
-    msg = "Video uses a non-standard and wasteful way to store B-frames"
+PACKED_B_FRAMES_TAGS = {"XVID", "DIVX", "DX50", "FMP4"}
+PACKED_B_FRAMES_PACKETS = 200
 
-    # Packed b-frames only apply to AVI files
-    f, ext = os.path.splitext(input_file)
-    if ext != ".avi":
+def packed_b_frames(info):
+    msg = "Video uses a non-standard and wasteful way to store B-frames"
+    v = info.video
+    if v is None or v.codec_name != "mpeg4" or not v.has_b_frames:
         return False
-
-    # Scan video to check for packed b-frames
-    data = ffmpeg_simulate(input_file)
-    if data.find(msg) == 0:
+    if v.codec_tag.upper() not in PACKED_B_FRAMES_TAGS:
         return False
-
-    # Convert if requested
-    if convert:
-        args = [
-            "-i",
-            input_file,
-            "-codec",
-            "copy",
-            "-bsf:v",
-            "mpeg4_unpack_bframes",
-            output_file,
-        ]
-        ffmpeg(*args)
-
-    # Confirm packed b-frames exist
-    return True
-
-# Chapter algorithm using scene detection
-def chapters_algorithm_scenes(filepath):
-
     try:
-        command = "ffprobe -v quiet -print_format json -show_frames -of compact=p=0 -f lavfi movie='" + filepath + "',select=gt(scene\,0.6) {}".format(filepath)
-        results = json.loads(subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True))
-    except:
-        return {}
-    return results
-
-# Chapter algorithm using duration of video
-def chapters_algorithm_duration(filepath: str, duration: float):
-    # Generate ffmetadata
-    # TODO: create the file in same folder as output directory and same filename as media file but with txt extension
-    ffmpeg_ffmetadata(filepath)
+        data = ffmpeg_simulate(info.filename, PACKED_B_FRAMES_PACKETS)
+    except RuntimeError:
+        return False
+    return msg in data
+
+# Chapter algorithm using scene and black frame detection
+# A single low resolution decode runs both detectors:
+#   ffmpeg -i input.avi -map 0:v:0 -vf "scale=320:-2,blackdetect=d=0.5:pix_th=0.1,select='gt(scene,0.4)',metadata=print" -f null -
+# blackdetect logs every black interval and metadata=print logs the time and score of every scene change,
+# both are parsed from ffmpeg's log while the decode is running.
+def chapter_events(filepath):
+    video_filter = "scale=320:-2,blackdetect=d=%s:pix_th=%s,select='gt(scene,%s)',metadata=print" % (
+        arg_chapter_black_duration, arg_chapter_black_threshold, arg_chapter_scene_threshold)
+    command = ["ffmpeg", "-hide_banner", "-nostdin", "-i", filepath, "-map", "0:v:0",
+               "-vf", video_filter, "-an", "-sn", "-f", "null", "-"]
+    black = re.compile(r"black_start:\s*([\d.]+)\s+black_end:\s*([\d.]+)")
+    frame = re.compile(r"pts_time:\s*([\d.]+)")
+    score = re.compile(r"lavfi\.scene_score=([\d.]+)")
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    pts_time = None
+    finished = False
+    try:
+        for line in process.stderr:
+            m = black.search(line)
+            if m:
+                yield ("black", float(m.group(1)), float(m.group(2)))
+                continue
+            m = frame.search(line)
+            if m:
+                pts_time = float(m.group(1))
+                continue
+            m = score.search(line)
+            if m and pts_time is not None:
+                yield ("scene", pts_time, float(m.group(1)))
+                pts_time = None
+        finished = True
+    finally:
+        if not finished:
+            process.kill()
+        wait_child(process)
+
+# Merge detected events into chapter boundaries at least `arg_chapter_min_length` apart
+# Black intervals (fade to black between scenes) are preferred over plain scene changes
+def merge_chapter_events(events, duration):
+    candidates = []
+    for kind, a, b in events:
+        if kind == "black":
+            candidates.append((1.0 + min(b - a, 5.0), (a + b) / 2))
+        else:
+            candidates.append((b, a))
+    candidates.sort(reverse=True)
+    boundaries = [0.0, duration]
+    for _, t in candidates:
+        # Events at or past the end (duration of the container is shorter than the stream) are no boundary
+        if not 0 < t < duration:
+            continue
+        pos = bisect.bisect_left(boundaries, t)
+        if t - boundaries[pos - 1] >= arg_chapter_min_length and boundaries[pos] - t >= arg_chapter_min_length:
+            boundaries.insert(pos, t)
+    return boundaries
 
-    # Generate chapters by slicing video
+# Chapter markers (milliseconds) from the boundaries of the chapters
+def chapter_markers(boundaries):
     markers = []
-    start = 0
-    end = duration
+    for i in range(len(boundaries) - 1):
+        markers.append({
+            "start": int(boundaries[i] * 1000),
+            "end": int(boundaries[i + 1] * 1000),
+            "title": "Chapter " + str(i + 1),
+        })
+    return markers
 
+def chapters_algorithm_scenes(filepath, duration):
+    boundaries = merge_chapter_events(chapter_events(filepath), duration)
+    return chapter_markers(boundaries)
+
+# FFMETADATA document with the global tags of the source and the chapters
+# Generated from the probe results, so no extra ffmpeg pass is needed to dump the metadata
+# https://ffmpeg.org/ffmpeg-formats.html#Metadata-1
+def ffmetadata_escape(value):
+    return re.sub(r"([=;#\\\n])", r"\\\1", str(value))
+
+def ffmetadata_document(tags, markers):
+    text = ";FFMETADATA1\n"
+    for key, value in tags.items():
+        # ffmpeg writes its own encoder tag
+        if key.lower() != "encoder":
+            text += "%s=%s\n" % (ffmetadata_escape(key), ffmetadata_escape(value))
+    for chap in markers:
+        text += "\n[CHAPTER]\nTIMEBASE=1/1000\nSTART=%s\nEND=%s\ntitle=%s\n" % (
+            chap["start"], int(chap["end"]) - 1, ffmetadata_escape(chap["title"]))
+    return text
+
+# Per job FFMETADATA file, removed by the caller after the encode
+def write_ffmetadata(text):
+    import tempfile
+    with tempfile.NamedTemporaryFile("w", prefix="ffmetadata-", suffix=".txt", dir=target_temp_dir,
+                                     delete=False, encoding="utf8") as f:
+        f.write(text)
+    return f.name
+
+# Chapter algorithm using duration of video
+# Chapters every 5 minutes, or every 10 minutes for videos longer than an hour
+def chapters_algorithm_duration(duration: float):
     if (duration / 60) / 60 > 1:
         step = 10 * 60
     else:
         step = 5 * 60
-    i = start
-    x = 1
-    while i < end:
-        item = {
-            "start": str(i * 1000),
-            "end": str((i + step) * 1000),
-            "title": "Chapter " + str(x),
-        }
-        markers.append(item)
-        i += step
-        x += 1
-
-    item = {
-        "start": str((i - step) * 1000),
-        "end": end * 1000,
-        "title": "Chapter " + str(x),
-    }
-    markers.append(item)
-    print(markers)
-
-    # Append chapter information into ffmetadata file
-    text = ""
-    for i in range(len(markers)-1):
-        chap = markers[i]
-        title = chap['title']
-        start = chap['start']
-        end = int(markers[i+1]['start'])-1
-        text += f"""
-[CHAPTER]
-TIMEBASE=1/1000
-START={start}
-END={end}
-title={title}
-"""
-    with open(FFMETADATA_FILE, "a") as f:
-        f.write(text)
-
-    return markers
-
-# Capture chapter information from ffmpeg output using regex
-def ffmpeg_parse_chapters(filepath):
-  chapters = []
-  command = [ "ffmpeg", '-i', filepath]
-  output = ""
-  m = None
-  title = None
-  chapter_match = None
-  
-  try:
-    output = subprocess.check_output(command, stderr=subprocess.STDOUT, universal_newlines=True)
-  except subprocess.CalledProcessError as e:
-    output = e.output
-
-  num = 1
-
-  for line in iter(output.splitlines()):
-    x = re.match(r".*title.*: (.*)", line)
-    print("x:")
-    pprint.pprint(x)
-
-    print("title:")
-    pprint.pprint(title)
-
-    if x == None:
-      m1 = re.match(r".*Chapter #(\d+:\d+): start (\d+\.\d+), end (\d+\.\d+).*", line)
-      title = None
-    else:
-      title = x.group(1)
-
-    if m1 != None:
-      chapter_match = m1
-
-    print("chapter_match:")
-    #pprint.pprint(chapter_match)
-
-    if title != None and chapter_match != None:
-      m = chapter_match
-      pprint.pprint(title)
+    boundaries = [float(t) for t in range(0, int(duration), step)] + [duration]
+    return chapter_markers(boundaries)
+
+# Chapters of a media file from the (cached) ffprobe results
+def probe_chapters(filepath):
+    return Chapters(ffprobe(filepath).get("chapters", []))
+
+
+# Walk the source directory once and yield media files as they are found
+# Hidden files and directories are skipped, extensions are matched case-insensitively
+def walk_media_files(source_dir, formats, stats=None):
+    extensions = {"." + ext.lower() for ext in formats}
+    if stats is None:
+        stats = {}
+    stats.update({"directories": 0, "entries": 0, "files": 0, "bytes": 0, "elapsed": 0.0, "start": time.time()})
+    # A single source file is converted whatever its extension
+    if os.path.isfile(source_dir):
+        stats.update({"files": 1, "bytes": os.path.getsize(source_dir)})
+        yield source_dir
+        return
+    # Only the walk itself is timed, not the time the consumer spends between files
+    elapsed = 0.0
+    walk_start = time.time()
+    visited = set()
+    stack = [source_dir]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            print_error("    ... ERROR, unable to read directory '%s': %s" % (directory, e))
+            continue
+        stats["directories"] += 1
+        stats["entries"] += len(entries)
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                st = entry.stat()
+                if (st.st_dev, st.st_ino) not in visited:
+                    visited.add((st.st_dev, st.st_ino))
+                    subdirs.append(entry.path)
+            elif os.path.splitext(entry.name)[1].lower() in extensions and entry.is_file():
+                stats["files"] += 1
+                stats["bytes"] += entry.stat().st_size
+                elapsed += time.time() - walk_start
+                yield entry.path
+                walk_start = time.time()
+        # Depth first, in name order
+        stack.extend(reversed(subdirs))
+    elapsed += time.time() - walk_start
+    stats["elapsed"] = round(elapsed, 2)
+
+# Probe and convert a single source file, returns the media item with timings
+# Directory that target paths are relative to, the parent directory of a single source file
+def source_root(source):
+    return os.path.dirname(source) if os.path.isfile(source) else source
+
+# Generate target file path with new extension
+def target_path(source_f_path, source_dir):
+    f_rel_path = os.path.relpath(source_f_path, source_dir)
+    temp_f_path = os.path.join(os.path.expanduser(arg_target_directory), f_rel_path)
+    f_base, f_ext = os.path.splitext(temp_f_path)
+    return f_base + "." + target_container
+
+# Probe stage: check the manifest and get media information for a source file
+def probe_source(source_f_path, target_f_path):
+    probe_start = time.time()
+    job = {"source": source_f_path, "target": target_f_path, "info": None}
+
+    with Span("probe", source_f_path):
+        # Skip sources already converted with the same settings
+        if arg_incremental and manifest_is_current(source_f_path, job["target"]):
+            job["status"] = "skipped"
+        else:
+            job["info"] = probe_media(source_f_path)
+            if job["info"]:
+                plans = plan_streams(job["info"])
+                # A linked or moved target takes no new space
+                job["passthrough"] = passthrough_possible(source_f_path, target_f_path, job["info"], plans)
+                job["source_size"] = job["info"].size or os.path.getsize(source_f_path)
+                job["predicted_size"] = 0 if job["passthrough"] else predict_output_size(job["info"], plans)
+    job["probe_elapsed"] = round(time.time() - probe_start, 2)
+    return job
+
+# Probe files ahead of the encoder, keeping up to `depth` probes in flight
+# Jobs are yielded in the same order as the files
+def prefetch_probes(files, source_dir, depth, workers):
+    from concurrent.futures import ThreadPoolExecutor
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for f in files:
+            pending.append(pool.submit(probe_source, f, target_path(f, source_dir)))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def mb(size):
+    return round(size / 1024**2, 1)
+
+def gb(size):
+    return round(size / 1024**3, 2)
+
+# Check that the converted file can be read and has every planned stream, returns the problem or None
+def validate_target(target_f_path, item):
+    results = ffprobe_uncached(target_f_path)
+    if not results:
+        return "ffprobe is not able to read the target"
+    info = MediaInfo(results)
+    expected = len([s for s in item.get("target_streams", []) if s[2] != "drop"])
+    if len(info.streams) < expected:
+        return "target has %s of %s planned streams" % (len(info.streams), expected)
+    duration = item.get("source_video_duration", 0)
+    if duration > 0 and info.duration < duration * 0.95:
+        return "target is %s seconds shorter than the source" % round(duration - info.duration, 1)
+    return None
+
+# Hidden file next to the target that an encode writes to, it is moved onto the target on success
+def partial_path(target_f_path):
+    directory, name = os.path.split(target_f_path)
+    stem, ext = os.path.splitext(name)
+    return os.path.join(directory, ".%s.partial%s" % (stem, ext))
+
+# Remove the partial file of a failed conversion
+# A source that was renamed onto it is the only copy of the file and is moved back instead
+def discard_partial(source_f_path, partial_f_path, renamed):
+    if not os.path.exists(partial_f_path):
+        return
+    if renamed:
+        os.rename(partial_f_path, source_f_path)
+        print_dim("    ... moved the source back to '%s'" % source_f_path)
     else:
-      m = None
-
-    if m != None:
-      chapters.append({ "name": str(num) + " - " + title, "start": m.group(2), "end": m.group(3)})
-      num += 1
-
-  print(chapters)
-  return chapters
+        os.remove(partial_f_path)
+
+# Encode stage: convert a probed source file, returns the media item with timings
+def convert_file(job, threads=0, progress=None):
+    source_f_path = job["source"]
+    target_f_path = job["target"]
+
+    # Start
+    task_start = time.time()
+    print_task("Convert media")
+    print("Source: '%s'" % source_f_path)
+
+    if job.get("status") == "skipped":
+        print_dim("    ... skipping, already converted to '%s'" % target_f_path)
+        return {"source": source_f_path, "target": target_f_path, "status": "skipped", "elapsed": 0.0}
+
+    # Media information was gathered by the probe stage
+    if job["info"] is None:
+        print_error("    ... ERROR, skipping due to ffprobe was not able to read file")
+        return None
+    print("    ... media information probed in %s seconds" % job["probe_elapsed"])
+
+    target_f_dir = os.path.dirname(target_f_path)
+    validate_directory(target_f_dir, True)
+
+    # Convert media into a partial file, the target only appears once it is complete and valid
+    # A partial file left behind by an interrupted run is started over
+    partial_f_path = partial_path(target_f_path)
+    if arg_convert and os.path.exists(target_f_path) and not arg_overwrite:
+        print_error("    ... ERROR, target already exists: '%s'" % target_f_path)
+        return {"source": source_f_path, "target": target_f_path, "status": "failed",
+                "error": "target already exists", "elapsed": 0.0}
+    if arg_convert and os.path.exists(partial_f_path):
+        os.remove(partial_f_path)
+    try:
+        item = ffmpeg_convert(source_f_path, target_f_path, job["info"], threads, progress, partial_f_path)
+    except BaseException:
+        discard_partial(source_f_path, partial_f_path,
+                        arg_passthrough == "rename" and not os.path.exists(source_f_path))
+        raise
+    item["source"] = source_f_path
+    item["target"] = target_f_path
+    item["probe_elapsed"] = job["probe_elapsed"]
+    item["source_size"] = job["source_size"]
+    item["predicted_size"] = job["predicted_size"]
+    if item.get("status") == "converted":
+        with Span("post-validate", source_f_path):
+            error = validate_target(partial_f_path, item)
+        if error:
+            print_error("    ... ERROR, %s: '%s'" % (error, target_f_path))
+            item["status"] = "failed"
+            item["error"] = error
+        else:
+            os.replace(partial_f_path, target_f_path)
+    if arg_convert:
+        discard_partial(source_f_path, partial_f_path, item.get("target_passthrough") == "renamed")
+    if arg_incremental and item.get("status") == "converted" and os.path.exists(source_f_path):
+        manifest_record(source_f_path, target_f_path)
+    if item.get("status") == "converted":
+        item["target_size"] = os.path.getsize(target_f_path)
+        print("Storage: %s MB -> %s MB (saved %s MB, predicted %s MB)" % (
+            mb(item["source_size"]), mb(item["target_size"]),
+            mb(item["source_size"] - item["target_size"]), mb(item["predicted_size"])))
+
+    # Stop Timer
+    task_stop = time.time()
+    item["elapsed"] = round(task_stop - task_start, 2)
+    print("Elapsed: %s seconds [%s minutes] '%s'" % (item["elapsed"], round(item["elapsed"]/60, 2), source_f_path))
+    return item
 
+# Ask on the terminal whether to convert the next file, end of input stops
+def ask_to_continue(source_f_path):
+    try:
+        answer = input("Continue with '%s'? [Y/n] " % source_f_path)
+    except EOFError:
+        return False
+    return answer.strip().lower() not in ("n", "no")
 
 def scanner():
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
     media_list = []
-    batch_total = 0
 
-    # Validate source directory
-    print("Source directory: '%s'" % arg_source_directory)
+    # Validate source directory (or single file)
+    print("Source: '%s'" % arg_source_directory)
     print("    ... validating directory")
     source_dir = validate_directory(arg_source_directory)
 
-    # Traverse source directory for matching media files
+    # Traverse source directory for matching media files, conversion starts while walking
     print("    ... traverse directory")
+    walk_stats = {}
     files = []
-    for ext in arg_source_formats:
-        pattern = os.path.join(source_dir, '**/*.' + ext)
-        for y in glob(pattern, recursive=True):
-            files.append(y)
-    files.sort()
-    for f in files:
-        print("    ... found: '" + f + "'")
-
-    for source_f_path in files:
-        # Start
-        task_start = time.time()
-        print_task("Convert media")
-        print("Source: '%s'" % source_f_path)
-
-        # Get source media file information
-        print("    ... get media information")
-        fprobe_results = ffprobe(source_f_path)
-        if fprobe_results == {}:
-            print_error("    ... ERROR, skipping due to ffprobe was not able to read file")
-            continue
+    def found(files_iter):
+        for f in files_iter:
+            print("    ... found: '" + f + "'")
+            files.append(f)
+            yield f
+    media_files = found(walk_media_files(source_dir, arg_source_formats, walk_stats))
+
+    # Probe media ahead of the encoder
+    jobs = prefetch_probes(media_files, source_root(source_dir), arg_probe_prefetch, arg_probe_jobs)
+
+    # Convert media with a pool of ffmpeg workers, jobs are held back while they
+    # would not fit on the target filesystem next to the running conversions
+    batch_start = time.time()
+    # Interactive runs convert one file at a time and ask before the next one
+    jobs_count = 1 if arg_interactive else encoder_jobs()
+    threads = job_threads(jobs_count)
+    if jobs_count > 1:
+        print("    ... converting with %s parallel jobs (%s threads each)" % (jobs_count, threads))
+    budget = SpaceBudget(arg_target_directory, arg_free_space_reserve) if arg_convert else None
+    held = deque()
+    running = {}
+    predicted_total = 0
+    stopped = threading.Event()
+
+    def collect(done):
+        for future in done:
+            job = running.pop(future)
+            if budget:
+                budget.release(job["target"])
+            item = future.result()
+            if item:
+                media_list.append(item)
+
+    def dispatch(pool):
+        for job in list(held):
+            if len(running) >= jobs_count:
+                return
+            needs_space = (budget and job.get("status") != "skipped" and job["info"] is not None
+                           and not job["passthrough"])
+            if needs_space and not budget.reserve(job["target"], job["predicted_size"]):
+                if not running:
+                    # Nothing running that could free up space
+                    held.remove(job)
+                    print_error("    ... ERROR, skipping '%s', needs %s GB but only %s GB are free on the target" % (
+                        job["source"], gb(job["predicted_size"]), gb(budget.free() - budget.reserve_bytes)))
+                    media_list.append({"source": job["source"], "target": job["target"], "status": "failed",
+                                       "elapsed": 0.0, "error": "not enough free space"})
+                continue
+            if arg_interactive and media_list and job.get("status") != "skipped" and not ask_to_continue(job["source"]):
+                print("    ... stopped, the remaining files are not converted")
+                held.clear()
+                stopped.set()
+                return
+            held.remove(job)
+            running[pool.submit(convert_file, job, threads)] = job
+
+    with ThreadPoolExecutor(max_workers=jobs_count) as pool:
+        for job in jobs:
+            if stopped.is_set():
+                break
+            predicted_total += job.get("predicted_size", 0)
+            held.append(job)
+            dispatch(pool)
+            # Only take the next probed job when an encoder is free
+            while running and (len(running) >= jobs_count or len(held) >= arg_probe_prefetch):
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+                dispatch(pool)
+        while running or held:
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+            dispatch(pool)
+    media_list.sort(key=lambda item: item["source"])
+    batch_stop = time.time()
+
+    walk_span = Span("walk", source_dir)
+    walk_span.start = walk_stats.get("start", batch_start)
+    walk_span.elapsed = walk_stats["elapsed"]
+    metrics_record(walk_span)
+
+    print("\nWalked %s directories (%s entries) in %s seconds, found %s media files [%s GB]" % (
+        walk_stats["directories"], walk_stats["entries"], walk_stats["elapsed"],
+        walk_stats["files"], round(walk_stats["bytes"] / 1024**3, 2)))
+
+    # Aggregate Timer
+    if files:
+        batch_total = round(batch_stop - batch_start, 2)
+        batch_total_minutes = round(batch_total/60, 2)
+        task_total = round(sum(item["elapsed"] for item in media_list), 2)
+        task_total_minutes = round(task_total/60, 2)
+        skipped = len([item for item in media_list if item.get("status") == "skipped"])
+        failed = len([item for item in media_list if item.get("status") == "failed"])
+        print("\nTotal files converted: %s" % (len(media_list) - skipped - failed))
+        print("Total files skipped (already converted): %s" % skipped)
+        print("Total files failed: %s" % failed)
+        print("Total elapsed: %s seconds [%s minutes]"% (batch_total, batch_total_minutes))
+        print("Total file time: %s seconds [%s minutes]"% (task_total, task_total_minutes))
+        converted = [item for item in media_list if "target_size" in item]
+        if converted:
+            source_total = sum(item["source_size"] for item in converted)
+            target_total = sum(item["target_size"] for item in converted)
+            print("Previous storage: %s GB, New storage: %s GB (saved %s GB)" % (
+                gb(source_total), gb(target_total), gb(source_total - target_total)))
+        if not arg_convert:
+            free = SpaceBudget(arg_target_directory).free()
+            print("Predicted storage: %s GB, free on target: %s GB" % (gb(predicted_total), gb(free)))
+            if predicted_total > free - arg_free_space_reserve:
+                print_error("WARNING: target directory does not have enough free space")
+        print_metrics()
+        print("")
+    return media_list
 
-        # Generate target file path with new extension
-        print("    ... determine target path")
-        f_rel_path = os.path.relpath(source_f_path, source_dir)
-        temp_f_path = os.path.join(arg_target_directory, f_rel_path)
-        f_base, f_ext = os.path.splitext(temp_f_path)
-        target_f_path = f_base + "." + target_container
-        target_f_dir = os.path.dirname(target_f_path)
-        validate_directory(target_f_dir, True)
 
-        # Convert media
-        item = ffmpeg_convert(source_f_path, target_f_path, fprobe_results)
-        media_list.append(item)
+# Durable job queue
+# Jobs move through pending -> probing -> encoding -> done | failed, or are cancelled.
+# Workers claim jobs atomically with a lease that they renew while working on the job,
+# so several `queue run` processes or remote workers can drain the same queue and the
+# jobs of a dead worker are reclaimed once its lease expires.
+QUEUE_STATES = ("pending", "probing", "encoding", "done", "failed", "cancelled")
+
+class JobCancelled(Exception):
+    pass
+
+_queue = None
+_queue_lock = threading.RLock()
+
+def job_queue():
+    global _queue
+    if _queue is None:
+        db = open_database(arg_queue)
+        db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT UNIQUE,
+            target TEXT,
+            state TEXT,
+            worker TEXT,
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            added REAL,
+            updated REAL,
+            lease_expires REAL,
+            metrics TEXT)""")
+        # Queues created before leases were added
+        columns = [row[1] for row in db.execute("PRAGMA table_info(jobs)")]
+        for column in ("lease_expires REAL", "metrics TEXT"):
+            if column.split()[0] not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN " + column)
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+        db.execute("CREATE TABLE IF NOT EXISTS queue_state (key TEXT PRIMARY KEY, value TEXT)")
+        db.commit()
+        _queue = db
+    return _queue
+
+def queue_worker_id(n=0):
+    import socket
+    return "%s:%s:%s" % (socket.gethostname(), os.getpid(), n)
+
+# Add the media files of a directory, failed and cancelled jobs are queued again
+def queue_add(source_directory):
+    source_dir = validate_directory(source_directory)
+    root = source_root(source_dir)
+    db = job_queue()
+    now = time.time()
+    count = 0
+    with _queue_lock:
+        for f in walk_media_files(source_dir, arg_source_formats):
+            db.execute("""INSERT INTO jobs (source, target, state, added, updated) VALUES (?, ?, 'pending', ?, ?)
+                ON CONFLICT (source) DO UPDATE SET state = 'pending', error = NULL, updated = excluded.updated
+                WHERE state IN ('failed', 'cancelled')""",
+                (os.path.abspath(f), target_path(f, root), now, now))
+            count += 1
+        db.commit()
+    print("    ... %s media files added to the queue" % count)
+    return count
 
-        # Stop Timer
-        task_stop = time.time()
+# Atomically move the oldest pending job to probing, returns None when there is nothing to do
+def queue_claim(worker):
+    db = job_queue()
+    with _queue_lock:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            job = None
+            if not queue_paused():
+                row = db.execute("SELECT id, source, target FROM jobs WHERE state = 'pending' ORDER BY id LIMIT 1").fetchone()
+                if row:
+                    now = time.time()
+                    db.execute("""UPDATE jobs SET state = 'probing', worker = ?, attempts = attempts + 1,
+                        lease_expires = ?, updated = ? WHERE id = ?""",
+                        (worker, now + arg_lease_seconds, now, row[0]))
+                    job = {"id": row[0], "source": row[1], "target": row[2]}
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+    return job
+
+# Extend the lease of a claimed job and optionally move it to another running state
+# Returns the job state, or "lost" when the job was reclaimed by another worker
+def queue_renew(job_id, worker, state=None):
+    db = job_queue()
+    now = time.time()
+    with _queue_lock:
+        db.execute("""UPDATE jobs SET state = COALESCE(?, state), lease_expires = ?, updated = ?
+            WHERE id = ? AND worker = ? AND state IN ('probing', 'encoding')""",
+            (state, now + arg_lease_seconds, now, job_id, worker))
+        db.commit()
+        row = db.execute("SELECT state, worker FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None or row[1] != worker:
+        return "lost"
+    return row[0]
+
+# Record the outcome of a claimed job, unless it was cancelled or reclaimed in the meantime
+def queue_complete(job_id, worker, state, error=None, metrics=None):
+    db = job_queue()
+    with _queue_lock:
+        db.execute("""UPDATE jobs SET state = ?, error = ?, metrics = ?, lease_expires = NULL, updated = ?
+            WHERE id = ? AND worker = ? AND state IN ('probing', 'encoding')""",
+            (state, error, json.dumps(metrics or {}), time.time(), job_id, worker))
+        db.commit()
+
+def queue_paused():
+    with _queue_lock:
+        row = job_queue().execute("SELECT value FROM queue_state WHERE key = 'paused'").fetchone()
+    return bool(row and row[0] == "1")
+
+def queue_set_paused(paused):
+    db = job_queue()
+    with _queue_lock:
+        db.execute("INSERT OR REPLACE INTO queue_state VALUES ('paused', ?)", ("1" if paused else "0",))
+        db.commit()
+    print("    ... queue %s" % ("paused" if paused else "resumed"))
+
+# Cancel pending and running jobs, all of them when no ids are given
+def queue_cancel(job_ids=None):
+    db = job_queue()
+    query = "UPDATE jobs SET state = 'cancelled', updated = ? WHERE state IN ('pending', 'probing', 'encoding')"
+    params = [time.time()]
+    if job_ids:
+        query += " AND id IN (%s)" % ",".join("?" * len(job_ids))
+        params.extend(job_ids)
+    with _queue_lock:
+        count = db.execute(query, params).rowcount
+        db.commit()
+    print("    ... %s jobs cancelled" % count)
+    return count
 
-        # Aggregate Timer
-        task_total = round(task_stop - task_start, 2)
-        task_total_minutes = round(task_total/60, 2)
-        batch_total = round(batch_total + task_total, 2)
-        batch_total_minutes = round(batch_total/60, 2)
-        print("Elapsed: %s seconds [%s minutes]" % (task_total, task_total_minutes))
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
 
-    if files:
-        print("\nTotal files converted: %s" % (len(files)))
-        print("Total elapsed: %s seconds [%s minutes]"% (batch_total, batch_total_minutes))
-        print("")
-    return media_list
+# Return running jobs to pending when their lease expired or their worker on this host is gone
+# With a worker prefix, only the jobs of those workers are returned (used on Ctrl-C)
+def queue_recover(worker_prefix=None):
+    import socket
+    db = job_queue()
+    host = socket.gethostname()
+    now = time.time()
+    recovered = 0
+    with _queue_lock:
+        rows = db.execute("SELECT id, worker, lease_expires FROM jobs WHERE state IN ('probing', 'encoding')").fetchall()
+        for job_id, worker, lease_expires in rows:
+            w_host, _, rest = (worker or "").partition(":")
+            w_pid = _to_int(rest.partition(":")[0])
+            if worker_prefix is not None:
+                stale = (worker or "").startswith(worker_prefix)
+            else:
+                stale = (lease_expires or 0) < now or (w_host == host and not _pid_alive(w_pid))
+            if stale:
+                db.execute("UPDATE jobs SET state = 'pending', worker = NULL, lease_expires = NULL, updated = ? WHERE id = ?",
+                           (now, job_id))
+                recovered += 1
+        db.commit()
+    if recovered:
+        print("    ... %s interrupted jobs returned to the queue" % recovered)
+    return recovered
+
+def queue_counts():
+    with _queue_lock:
+        return dict(job_queue().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+def queue_status():
+    db = job_queue()
+    counts = queue_counts()
+    print("Queue: '%s'%s" % (os.path.expanduser(arg_queue), " (paused)" if queue_paused() else ""))
+    for state in QUEUE_STATES:
+        print("    ... %-9s %s" % (state, counts.get(state, 0)))
+    workers = {}
+    with _queue_lock:
+        rows = db.execute("SELECT id, state, attempts, source, error, worker, metrics FROM jobs "
+                          "WHERE state != 'pending' ORDER BY id").fetchall()
+    for job_id, state, attempts, source, error, worker, metrics in rows:
+        if state == "done" and worker:
+            totals = workers.setdefault(worker.rpartition(":")[0], [0, 0.0, 0])
+            metrics = json.loads(metrics or "{}")
+            totals[0] += 1
+            totals[1] += metrics.get("elapsed", 0.0)
+            totals[2] += metrics.get("encode_frames", 0)
+        elif state != "done":
+            print("    %5s %-9s attempts=%s '%s'%s%s" % (job_id, state, attempts, source,
+                  " [%s]" % worker if state in ("probing", "encoding") else "", " " + error if error else ""))
+    for worker, (jobs, elapsed, frames) in sorted(workers.items()):
+        print("    ... worker %s: %s jobs in %s seconds (%s fps)" % (
+            worker, jobs, round(elapsed, 2), round(frames / elapsed, 2) if elapsed else 0.0))
+    return counts
+
+# Queue backends for workers: the local queue database or a coordinator over HTTP
+class LocalQueue:
+    def claim(self, worker):
+        return queue_claim(worker)
+
+    def renew(self, job_id, worker, state=None):
+        return queue_renew(job_id, worker, state)
+
+    def complete(self, job_id, worker, state, error=None, metrics=None):
+        queue_complete(job_id, worker, state, error, metrics)
+
+    def paused(self):
+        return queue_paused()
+
+class RemoteQueue:
+    def __init__(self, url, path_map=(), token=None):
+        self.url = url.rstrip("/")
+        self.path_map = path_map
+        self.token = token
+        # Jobs may only touch files below the local mount points, or the configured directories without a map
+        self.roots = ([os.path.normpath(local) for _, local in path_map]
+                      or [os.path.normpath(arg_source_directory), os.path.normpath(arg_target_directory)])
+
+    def _request(self, path, data=None):
+        import urllib.request
+        body = json.dumps(data).encode() if data is not None else None
+        headers = {"Content-Type": "application/json", COORDINATOR_TOKEN_HEADER: self.token or ""}
+        request = urllib.request.Request(self.url + path, data=body, headers=headers)
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return json.loads(response.read() or b"{}")
+
+    # Translate a path on the coordinator to the mount point of the share on this host
+    def _local_path(self, path):
+        for remote, local in self.path_map:
+            if path.startswith(remote):
+                return local + path[len(remote):]
+        return path
+
+    def _allowed(self, path):
+        path = os.path.normpath(path)
+        return any(path == root or path.startswith(root.rstrip(os.sep) + os.sep) for root in self.roots)
+
+    # Jobs with paths outside of this host's directories are failed instead of converted
+    def claim(self, worker):
+        while True:
+            job = self._request("/lease", {"worker": worker}).get("job")
+            if not job:
+                return job
+            job["source"] = self._local_path(job["source"])
+            job["target"] = self._local_path(job["target"])
+            if self._allowed(job["source"]) and self._allowed(job["target"]):
+                return job
+            print_error("    ... ERROR, rejecting job %s, '%s' -> '%s' is outside of %s" % (
+                job["id"], job["source"], job["target"], ", ".join(self.roots)))
+            self.complete(job["id"], worker, "failed", "paths outside of the worker's directories")
+
+    def renew(self, job_id, worker, state=None):
+        return self._request("/renew", {"id": job_id, "worker": worker, "state": state})["state"]
+
+    def complete(self, job_id, worker, state, error=None, metrics=None):
+        self._request("/complete", {"id": job_id, "worker": worker, "state": state, "error": error, "metrics": metrics})
+
+    def paused(self):
+        return self._request("/status").get("paused", False)
+
+# Process a claimed job while a heartbeat renews its lease
+# The progress callback stops ffmpeg when the job gets cancelled or its lease is lost
+def queue_process(backend, job, worker, threads):
+    job_id = job["id"]
+    cancelled = threading.Event()
+    finished = threading.Event()
+
+    def heartbeat():
+        while not finished.wait(arg_queue_poll):
+            try:
+                if backend.renew(job_id, worker) in ("cancelled", "lost"):
+                    cancelled.set()
+            except Exception as e:
+                print_error("    ... ERROR, unable to renew lease of job %s: %s" % (job_id, e))
+
+    def progress(event):
+        if cancelled.is_set():
+            raise JobCancelled()
+
+    beat = threading.Thread(target=heartbeat, daemon=True)
+    beat.start()
+    try:
+        probed = probe_source(job["source"], job["target"])
+        if backend.renew(job_id, worker, "encoding") in ("cancelled", "lost"):
+            return
+        try:
+            item = convert_file(probed, threads, progress)
+        except JobCancelled:
+            # The partial target was removed by convert_file
+            print_error("    ... cancelled '%s'" % job["source"])
+            return
+    finally:
+        finished.set()
+        beat.join()
+    metrics = {key: value for key, value in (item or {}).items()
+               if key in ("status", "elapsed", "probe_elapsed", "encode_frames", "encode_fps", "encode_speed")}
+    if item is None:
+        backend.complete(job_id, worker, "failed", "ffprobe was not able to read file", metrics)
+    elif item.get("status") == "failed":
+        backend.complete(job_id, worker, "failed", "conversion failed", metrics)
+    else:
+        backend.complete(job_id, worker, "done", None, metrics)
+
+def queue_worker(backend, n, threads, stop, wait_for_jobs=False):
+    worker = queue_worker_id(n)
+    while not stop.is_set():
+        try:
+            job = backend.claim(worker)
+            if job is None and not wait_for_jobs and not backend.paused():
+                return
+        except OSError as e:
+            print_error("    ... ERROR, unable to claim a job: %s" % e)
+            stop.wait(arg_queue_poll)
+            continue
+        if job is None:
+            stop.wait(arg_queue_poll)
+            continue
+        try:
+            queue_process(backend, job, worker, threads)
+        except Exception as e:
+            print_error("    ... ERROR, job %s failed: %s" % (job["id"], e))
+            try:
+                backend.complete(job["id"], worker, "failed", str(e))
+            except OSError as e:
+                # The lease expires and the coordinator hands the job out again
+                print_error("    ... ERROR, unable to report job %s: %s" % (job["id"], e))
+                stop.wait(arg_queue_poll)
+
+# Run parallel workers until the queue is drained, interrupted jobs go back to pending
+def queue_workers(backend, wait_for_jobs=False):
+    jobs_count = encoder_jobs()
+    threads = job_threads(jobs_count)
+    stop = threading.Event()
+    workers = [threading.Thread(target=queue_worker, args=(backend, n, threads, stop, wait_for_jobs), daemon=True)
+               for n in range(jobs_count)]
+    for w in workers:
+        w.start()
+    try:
+        for w in workers:
+            while w.is_alive():
+                w.join(1)
+    finally:
+        stop.set()
+
+def queue_run():
+    import socket
+    queue_recover()
+    try:
+        queue_workers(LocalQueue())
+    finally:
+        # Ctrl-C or crash: release the jobs of this process
+        queue_recover(worker_prefix="%s:%s:" % (socket.gethostname(), os.getpid()))
+    queue_status()
+    print_metrics()
+
+# Coordinator: serves the local queue to workers on other hosts over HTTP
+# Mixed into http.server's BaseHTTPRequestHandler by coordinator(), which imports it on demand
+COORDINATOR_TOKEN_HEADER = "X-Media-Manager-Token"
+
+# Shared secret of the coordinator and its workers
+def coordinator_token():
+    return arg_coordinator_token or os.environ.get("MEDIA_MANAGER_TOKEN")
+
+# Requests of the coordinator, every one has to carry the token of the server
+class CoordinatorHandler:
+    token = ""
+
+    def _authorized(self):
+        import hmac
+        given = self.headers.get(COORDINATOR_TOKEN_HEADER, "").encode()
+        if self.token and hmac.compare_digest(given, self.token.encode()):
+            return True
+        self._reply({"error": "unauthorized"}, 401)
+        return False
+
+    def _reply(self, data, code=200):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path == "/status":
+            self._reply({"paused": queue_paused(), "counts": queue_counts()})
+        else:
+            self._reply({"error": "not found"}, 404)
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        data = json.loads(self.rfile.read(_to_int(self.headers.get("Content-Length"))) or b"{}")
+        if self.path == "/lease":
+            self._reply({"job": queue_claim(data["worker"])})
+        elif self.path == "/renew":
+            self._reply({"state": queue_renew(data["id"], data["worker"], data.get("state"))})
+        elif self.path == "/complete":
+            queue_complete(data["id"], data["worker"], data["state"], data.get("error"), data.get("metrics"))
+            self._reply({})
+        else:
+            self._reply({"error": "not found"}, 404)
+
+    def log_message(self, format, *args):
+        if arg_verbose:
+            print_dim("    ... %s %s" % (self.address_string(), format % args))
+
+# Plan the jobs of a directory (optional) and hand them out to workers until interrupted
+def coordinator(source_directory=None):
+    if source_directory:
+        queue_add(source_directory)
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    token = coordinator_token()
+    if not token:
+        import secrets
+        token = secrets.token_urlsafe(24)
+        print("    ... generated token, start the workers with --token %s" % token)
+    class Handler(CoordinatorHandler, BaseHTTPRequestHandler):
+        pass
+    Handler.token = token
+    host, _, port = arg_coordinator.rpartition(":")
+    server = ThreadingHTTPServer((host, int(port)), Handler)
+    print("    ... coordinator listening on %s" % arg_coordinator)
+
+    # Reclaim the jobs of workers whose lease expired
+    def reaper():
+        while True:
+            time.sleep(arg_queue_poll)
+            queue_recover()
+    threading.Thread(target=reaper, daemon=True).start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+# Worker: lease jobs from a coordinator and convert them on this host
+def worker(url, path_map=()):
+    token = coordinator_token()
+    if not token:
+        print_error("    ... ERROR, the token of the coordinator is needed (--token or MEDIA_MANAGER_TOKEN)")
+        return
+    print("    ... worker %s pulling jobs from %s" % (queue_worker_id(), url))
+    queue_workers(RemoteQueue(url, path_map, token), wait_for_jobs=True)
+
+# convert.py queue add [SOURCE] | run | pause | resume | cancel ID ...|all | status
+def queue_command(args):
+    command = getattr(args, "queue_command", None) or "status"
+    if command == "add":
+        queue_add(args.source or arg_source_directory)
+    elif command == "run":
+        queue_run()
+    elif command == "pause":
+        queue_set_paused(True)
+    elif command == "resume":
+        queue_set_paused(False)
+    elif command == "cancel" and args.ids == ["all"]:
+        queue_cancel()
+    elif command == "cancel":
+        queue_cancel([int(x) for x in args.ids])
+    elif command == "status":
+        queue_status()
+
+# Encode a short segment of a sample file and measure the encoder
+def benchmark_encode(sample, preset, threads, output):
+    args = ["-ss", str(sample["start"]), "-t", str(arg_benchmark_seconds), "-i", sample["source"],
+            "-map", "0:v:0", "-an", "-sn", "-c:v", target_video_codec, "-crf", target_video_quality,
+            "-preset", preset]
+    if threads:
+        args.extend(["-threads", str(threads)])
+    args.extend(["-f", "matroska", output])
+    event = ffmpeg_run(*args)
+    return {
+        "frames": event.frame if event else 0,
+        "elapsed": event.elapsed if event else 0.0,
+        "size": os.path.getsize(output),
+        "seconds": min(arg_benchmark_seconds, sample["duration"]),
+        "pixels": sample["pixels"],
+    }
+
+# Pick evenly spaced sample files from the source directory
+def benchmark_samples(source_dir):
+    files = sorted(walk_media_files(source_dir, arg_source_formats))
+    step = max(1, len(files) // max(1, arg_benchmark_samples))
+    samples = []
+    for f in files[::step]:
+        info = probe_media(f)
+        if info is None or info.video is None or info.duration <= 0:
+            continue
+        # Skip the intro, encode from a third into the file
+        start = round(info.duration / 3, 2) if info.duration > arg_benchmark_seconds * 3 else 0
+        samples.append({"source": f, "start": start, "duration": info.duration - start,
+                        "pixels": info.width * info.height})
+        if len(samples) >= arg_benchmark_samples:
+            break
+    return samples
+
+# Measure x264 presets, -threads values and concurrent jobs on a sample of the library
+# and write the fastest setting with an acceptable bitrate to the encoder profile
+def benchmark():
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    print_task("Benchmark encoder")
+    source_dir = validate_directory(arg_source_directory)
+    samples = benchmark_samples(source_dir)
+    if not samples:
+        print_error("    ... ERROR, no media files found to benchmark in '%s'" % source_dir)
+        return None
+    for sample in samples:
+        print("    ... sample: '%s' from %s seconds" % (sample["source"], sample["start"]))
+
+    results = []
+    temp_dir = tempfile.mkdtemp(prefix="benchmark-", dir=target_temp_dir)
+    try:
+        for preset in arg_benchmark_presets:
+            for threads in arg_benchmark_threads:
+                for jobs in arg_benchmark_jobs:
+                    if threads * jobs > arg_threads or (threads == 0 and jobs > 1):
+                        continue
+                    # Run `jobs` encodes at the same time, cycling through the samples
+                    outputs = [os.path.join(temp_dir, "%s-%s-%s-%s.mkv" % (preset, threads, jobs, i)) for i in range(jobs)]
+                    start = time.time()
+                    try:
+                        with ThreadPoolExecutor(max_workers=jobs) as pool:
+                            runs = list(pool.map(
+                                lambda i: benchmark_encode(samples[i % len(samples)], preset, threads, outputs[i]),
+                                range(jobs)))
+                    except RuntimeError as e:
+                        print_error("    ... ERROR, preset=%s threads=%s jobs=%s failed" % (preset, threads, jobs))
+                        print_dim(str(e))
+                        continue
+                    finally:
+                        for output in outputs:
+                            if os.path.exists(output):
+                                os.remove(output)
+                    wall = time.time() - start
+                    result = {
+                        "preset": preset,
+                        "threads": threads,
+                        "jobs": jobs,
+                        "wall": round(wall, 2),
+                        # Frames per second over all concurrent jobs, i.e. throughput of the host
+                        "fps": round(sum(r["frames"] for r in runs) / wall, 2),
+                        # Frames per second of a single job
+                        "job_fps": round(sum(r["frames"] / r["elapsed"] for r in runs if r["elapsed"]) / len(runs), 2),
+                        "bitrate": round(sum(r["size"] * 8 for r in runs) / sum(r["seconds"] for r in runs) / 1000),
+                        "pixels": round(sum(r["pixels"] for r in runs) / len(runs)),
+                    }
+                    print("    ... preset=%(preset)s threads=%(threads)s jobs=%(jobs)s: %(fps)s fps, "
+                          "%(bitrate)s kbit/s, %(wall)s seconds" % result)
+                    results.append(result)
+    finally:
+        os.rmdir(temp_dir)
+    if not results:
+        return None
+
+    # Fastest setting whose bitrate is close to the most efficient preset
+    lowest_bitrate = min(r["bitrate"] for r in results)
+    candidates = [r for r in results if r["bitrate"] <= lowest_bitrate * arg_benchmark_bitrate_tolerance]
+    best = max(candidates, key=lambda r: r["fps"])
+    profile = dict(best, created=time.time(), video_codec=target_video_codec,
+                   video_quality=target_video_quality, results=results)
+    path = os.path.expanduser(target_encoder_profile)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+    print("Best: preset=%(preset)s threads=%(threads)s jobs=%(jobs)s (%(fps)s fps, %(bitrate)s kbit/s)" % best)
+    print("Encoder profile written to '%s'" % path)
+    global _encoder_profile
+    _encoder_profile = profile
+    return profile
 
 
 def clean_filename(f_base):
@@ -644,13 +2576,243 @@ def validate_directory(path, create=False):
             print("    ... not creating target directory (dry run mode)")
     return p
 
-def main():
+# Probe single files and show what a conversion would do with their streams
+def probe_command(sources):
+    for source in sources:
+        print("Source: '%s'" % source)
+        info = probe_media(source)
+        if info is None:
+            print_error("    ... ERROR, unable to probe '%s'" % source)
+            continue
+        print("    ... format = %s, duration = %s seconds, size = %s MB, chapters = %s" % (
+            info.format_name, round(info.duration, 1), mb(info.size), len(info.chapters)))
+        print_stream_plans(plan_streams(info))
+
+# Plan entry of a probed job: what happens to every stream, predicted size and encode time
+def plan_record(job):
+    record = {"source": job["source"], "target": job["target"], "status": job.get("status")}
+    info = job["info"]
+    if record["status"] == "skipped":
+        return record
+    if info is None:
+        record["status"] = "failed"
+        return record
+    plans = plan_streams(info)
+    actions = [plan.action for plan in plans]
+    record.update({
+        "status": ("transcode" if "transcode" in actions else
+                   "passthrough" if job["passthrough"] else "remux"),
+        "duration": round(info.duration, 2),
+        "video_codec": info.video_codec,
+        "width": info.width,
+        "height": info.height,
+        "scale": any(plan.reason == "scaling" for plan in plans),
+        "copy": actions.count("copy"),
+        "transcode": actions.count("transcode"),
+        "drop": actions.count("drop"),
+        "streams": [{"index": plan.stream.index, "type": plan.stream.codec_type, "codec": plan.stream.codec_name,
+                     "action": plan.action, "target_codec": plan.codec, "reason": plan.reason} for plan in plans],
+        "source_size": job["source_size"],
+        "predicted_size": job["predicted_size"],
+        "encode_seconds": predict_encode_seconds(info, plans),
+    })
+    return record
+
+PLAN_CSV_FIELDS = ("source", "target", "status", "duration", "video_codec", "width", "height", "scale",
+                   "copy", "transcode", "drop", "streams", "source_size", "predicted_size", "encode_seconds")
+
+# Write a plan as one JSON document or as CSV rows, a record at a time
+def write_plan(out, records, output_format):
+    if output_format == "csv":
+        import csv
+        writer = csv.DictWriter(out, PLAN_CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for record in records:
+            if "streams" in record:
+                # index:type:codec>action[:target codec]
+                record = dict(record, streams=" ".join(
+                    "%s:%s:%s>%s%s" % (s["index"], s["type"], s["codec"], s["action"],
+                                       ":" + s["target_codec"] if s["target_codec"] else "")
+                    for s in record["streams"]))
+            writer.writerow(record)
+            out.flush()
+    else:
+        out.write('{"files": [')
+        separator = "\n"
+        for record in records:
+            out.write(separator + json.dumps(record))
+            separator = ",\n"
+            out.flush()
+        out.write("\n],\n")
+
+# Probe a library in parallel (cached) and write the conversion plan of every file with totals
+# Records are written as soon as their file is probed so memory stays flat for any library size
+def plan_command(source, output=None, output_format="json"):
+    import contextlib
+    out = open(output, "w", newline="") if output else sys.stdout
+    totals = {"files": 0, "transcode": 0, "remux": 0, "passthrough": 0, "skipped": 0, "failed": 0,
+              "source_size": 0, "predicted_size": 0, "encode_seconds": 0.0}
+    def records(jobs):
+        for job in jobs:
+            record = plan_record(job)
+            totals["files"] += 1
+            totals[record["status"]] += 1
+            totals["source_size"] += record.get("source_size", 0)
+            totals["predicted_size"] += record.get("predicted_size", 0)
+            totals["encode_seconds"] += record.get("encode_seconds") or 0.0
+            yield record
+    try:
+        # Only the plan goes to stdout, messages go to stderr
+        with contextlib.redirect_stdout(sys.stderr):
+            source_dir = validate_directory(source)
+            files = walk_media_files(source_dir, arg_source_formats)
+            depth = max(arg_probe_prefetch, arg_probe_jobs * 2)
+            jobs = prefetch_probes(files, source_root(source_dir), depth, arg_probe_jobs)
+            write_plan(out, records(jobs), output_format)
+            profile = encoder_profile()
+            totals["encode_seconds"] = round(totals["encode_seconds"], 1)
+            # Parallel jobs share the host, its throughput was measured by the benchmark
+            totals["wall_seconds"] = (round(totals["encode_seconds"] * profile["job_fps"] / profile["fps"], 1)
+                                      if profile.get("fps") and profile.get("job_fps") else None)
+            totals["target_free"] = SpaceBudget(arg_target_directory).free()
+        if output_format == "json":
+            out.write('"totals": %s}\n' % json.dumps(totals))
+    finally:
+        if output:
+            out.close()
+    print("Planned %(files)s files: %(transcode)s transcode, %(remux)s remux, %(passthrough)s passthrough, "
+          "%(skipped)s skipped, %(failed)s failed" % totals, file=sys.stderr)
+    print("Predicted storage: %s GB (source %s GB), free on target: %s GB, encode time: %s hours" % (
+        gb(totals["predicted_size"]), gb(totals["source_size"]), gb(totals["target_free"]),
+        round((totals["wall_seconds"] or totals["encode_seconds"]) / 3600, 1)), file=sys.stderr)
+    return totals
+
+# Command line, options override the default settings at the top of this file
+def parse_arguments(argv):
+    import argparse
+    # Options that are not given keep the default settings
+    parser = argparse.ArgumentParser(prog="convert.py", argument_default=argparse.SUPPRESS,
+        description="Convert video files to a format supported by Roku.")
+    parser.add_argument("-n", "--dry-run", dest="arg_convert", action="store_false",
+        help="probe and plan without converting")
+    parser.add_argument("-q", "--quiet", dest="arg_verbose", action="store_false",
+        help="do not show ffmpeg commands and chapter details")
+    parser.add_argument("-i", "--interactive", dest="arg_interactive", action="store_true",
+        help="ask to continue after each file")
+    parser.add_argument("--overwrite", dest="arg_overwrite", action="store_true",
+        help="overwrite existing target files")
+    parser.add_argument("--passthrough", dest="arg_passthrough", choices=["link", "rename", "off"],
+        help="mkv sources that need no change are reflinked or hardlinked, moved or remuxed (default: %s)"
+        % arg_passthrough)
+    parser.add_argument("-t", "--target", dest="arg_target_directory", metavar="DIR",
+        help="target directory (default: %s)" % arg_target_directory)
+    parser.add_argument("-j", "--jobs", dest="arg_jobs", type=int, metavar="N",
+        help="files converted in parallel (default: encoder profile or 1)")
+    parser.add_argument("--threads", dest="arg_threads", type=int, metavar="N",
+        help="ffmpeg threads shared by all jobs (default: %s)" % arg_threads)
+    parser.add_argument("--segments", dest="arg_segments", type=int, metavar="N",
+        help="encode long files as N segments in parallel")
+    parser.add_argument("--chapters", dest="arg_chapters", choices=["copy", "remove", "duration", "detect-scenes"],
+        help="chapters of the target (default: %s)" % arg_chapters)
+    parser.add_argument("--subtitles", dest="arg_subtitles", choices=["copy", "remove"],
+        help="subtitles of the target (default: %s)" % arg_subtitles)
+    parser.add_argument("--upscaling", dest="arg_upscaling", action=argparse.BooleanOptionalAction,
+        help="scale videos below 1080p up (default: %s)" % arg_upscaling)
+    parser.add_argument("--downscaling", dest="arg_downscaling", action=argparse.BooleanOptionalAction,
+        help="scale videos above 1080p down (default: %s)" % arg_downscaling)
+    parser.add_argument("--incremental", dest="arg_incremental", action=argparse.BooleanOptionalAction,
+        help="skip sources already converted with the same settings (default: %s)" % arg_incremental)
+    parser.add_argument("--probe-jobs", dest="arg_probe_jobs", type=int, metavar="N",
+        help="ffprobe processes running in parallel (default: %s)" % arg_probe_jobs)
+    parser.add_argument("--probe-cache", dest="arg_probe_cache", metavar="PATH",
+        help="ffprobe cache database (default: %s)" % arg_probe_cache)
+    parser.add_argument("--manifest", dest="arg_manifest", metavar="PATH",
+        help="database of converted sources (default: %s)" % arg_manifest)
+    parser.add_argument("--queue", dest="arg_queue", metavar="PATH",
+        help="job queue database (default: %s)" % arg_queue)
+    parser.add_argument("--metrics", dest="arg_metrics", metavar="PATH",
+        help="append a JSON line per stage span (walk, probe, plan, encode, ...) to a file")
+    parser.add_argument("--metrics-prometheus", dest="arg_metrics_prometheus", metavar="PATH",
+        help="write the stage totals as a Prometheus textfile at the end of the run")
+
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    scan = commands.add_parser("scan", help="convert the media files of a directory or a single file (default)")
+    scan.add_argument("source", nargs="?", help="directory or file (default: %s)" % arg_source_directory)
+    plan = commands.add_parser("plan", help="write the conversion plan of a library as JSON or CSV")
+    plan.add_argument("source", nargs="?", help="directory or file (default: %s)" % arg_source_directory)
+    plan.add_argument("--format", dest="plan_format", choices=["json", "csv"], default="json",
+        help="report format (default: json)")
+    plan.add_argument("-o", "--output", metavar="FILE", help="write the plan to a file instead of stdout")
+    probe = commands.add_parser("probe", help="show the streams of files and what a conversion would do")
+    probe.add_argument("sources", nargs="+", metavar="FILE")
+    commands.add_parser("benchmark", help="measure encoder settings and write the encoder profile")
+    queue = commands.add_parser("queue", help="manage the persistent job queue")
+    queue_commands = queue.add_subparsers(dest="queue_command", metavar="COMMAND")
+    queue_add_parser = queue_commands.add_parser("add", help="add the media files of a directory or a single file")
+    queue_add_parser.add_argument("source", nargs="?", help="directory or file (default: %s)" % arg_source_directory)
+    queue_commands.add_parser("run", help="convert queued jobs until the queue is empty")
+    queue_commands.add_parser("pause", help="stop handing out jobs")
+    queue_commands.add_parser("resume", help="hand out jobs again")
+    queue_cancel_parser = queue_commands.add_parser("cancel", help="cancel jobs")
+    queue_cancel_parser.add_argument("ids", nargs="+", metavar="ID", help="job ids or 'all'")
+    queue_commands.add_parser("status", help="show the job counts (default)")
+    coordinator_parser = commands.add_parser("coordinator", argument_default=argparse.SUPPRESS,
+        help="serve the job queue to remote workers")
+    coordinator_parser.add_argument("source", nargs="?", default=None, help="directory or file to queue first")
+    coordinator_parser.add_argument("--listen", dest="arg_coordinator", metavar="HOST:PORT",
+        help="listen address (default: %s)" % arg_coordinator)
+    coordinator_parser.add_argument("--token", dest="arg_coordinator_token", metavar="TOKEN",
+        help="shared secret the workers have to send (default: MEDIA_MANAGER_TOKEN, or generated)")
+    worker_parser = commands.add_parser("worker", help="convert jobs leased from a coordinator")
+    worker_parser.add_argument("url", help="coordinator URL, for example http://nas:8765")
+    worker_parser.add_argument("path_map", nargs="*", metavar="REMOTE=LOCAL",
+        help="map a path prefix on the coordinator to the local mount point")
+    worker_parser.add_argument("--token", dest="arg_coordinator_token", metavar="TOKEN", default=argparse.SUPPRESS,
+        help="shared secret of the coordinator (default: MEDIA_MANAGER_TOKEN)")
+
+    args = parser.parse_args(argv)
+    if getattr(args, "queue_command", None) == "cancel" and args.ids != ["all"] and not all(x.isdigit() for x in args.ids):
+        parser.error("queue cancel takes job ids or 'all'")
+    if getattr(args, "command", None) == "worker" and not all("=" in m for m in args.path_map):
+        parser.error("worker path maps are given as REMOTE=LOCAL")
+    return args
+
+def main(argv=None):
+    args = parse_arguments(sys.argv[1:] if argv is None else argv)
+    globals().update({name: value for name, value in vars(args).items() if name.startswith("arg_")})
+    command = getattr(args, "command", None) or "scan"
+    if command == "scan" and getattr(args, "source", None):
+        globals()["arg_source_directory"] = args.source
+
     signal.signal(signal.SIGINT, signal_handler)
 
+    try:
+        run_command(command, args)
+    finally:
+        if arg_metrics_prometheus:
+            write_prometheus_metrics(arg_metrics_prometheus)
+
+def run_command(command, args):
+    if command == "plan":
+        # Machine readable output only
+        plan_command(args.source or arg_source_directory, args.output, args.plan_format)
+        return
+
     print_header("Video Converter (by John Wadleigh)")
 
-    media_list = scanner()
-    print("Found " + str(len(media_list)) + " media files\n\n")
+    if command == "probe":
+        probe_command(args.sources)
+    elif command == "benchmark":
+        benchmark()
+    elif command == "queue":
+        queue_command(args)
+    elif command == "coordinator":
+        coordinator(args.source)
+    elif command == "worker":
+        worker(args.url, [tuple(m.split("=", 1)) for m in args.path_map] or arg_path_map)
+    else:
+        media_list = scanner()
+        print("Found " + str(len(media_list)) + " media files\n\n")
 
 
 if __name__ == "__main__":
@@ -673,20 +2835,8 @@ if __name__ == "__main__":
 # python code to generate chapters into mp4
 # https://gist.github.com/Elenesgu/ba4e5cd81f9c98ab5979b3db62aea7cc
 
-# detect chapters/scenes using black detection algorithm:
-#   ffmpeg -i input.avi -vf blackdetect=d=0.232:pix_th=0.1 -an -f null - 2>&1 | findstr black_duration > output.txt
-#   ffmpeg -i input.avi -vf blackdetect=d=0.232:pix_th=0.1 -an -f null - 2>&1
-#   ffprobe -f lavfi -i "movie=input.mp4,blackdetect[out0]" -show_entries tags=lavfi.black_start,lavfi.black_end -of default=nw=1 -v quiet
-#   ffmpeg -i input.handbrake.mkv -vf blackdetect=d=0.232:pix_th=0.1 -an -f null - 2>&1 | grep black_duration > output3.txt
-
-# detect chapters/scenes using scene detection algorithm:
-#   ffmpeg -hide_banner -i input.avi -filter_complex "select='gt(scene,0.5)',metadata=print:file=time.txt" -vsync vfr img%03d.png
-
 # TODO: Progress bar over all files (1 of 150) perhaps displayed after each file? how to make this persistent
 
-# TODO: Queues: run multiple `convert` sessions where each time I run the program it adds to the "queue"
-#           allow pause, cancel and continue the queue
-
 # TODO: Fix media filenames and search IMDB or something for the episode titles
 # GOT_S01E01.mkv would be converted to 'S01E01 - <episode title>.mkv"
 
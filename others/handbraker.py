@@ -12,19 +12,99 @@ import argparse
 import base64
 import bz2
 import json
-import re
+import os
 import shutil
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from string import Template
 
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+FICLONE = 0x40049409  # linux ioctl sharing the extents of a file (btrfs, xfs, bcachefs)
+COPY_BUFFER = 8 * 1024 * 1024
+
+
+def copy_file(src, dst):
+    """Copy src to dst and keep its mtime, so that an unchanged file is skipped next time.
+    Tries a reflink first, then an in-kernel os.copy_file_range, then large buffered copies.
+    Returns the method used or None when dst already had the same size and mtime.
+    """
+    st = os.stat(src)
+    try:
+        st_dst = os.stat(dst)
+        if st_dst.st_size == st.st_size and st_dst.st_mtime_ns == st.st_mtime_ns:
+            return None
+    except FileNotFoundError:
+        pass
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        method = "reflink"
+        try:
+            if fcntl is None or not sys.platform.startswith("linux"):
+                raise OSError("reflink not supported")
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            method = "copy"
+            if hasattr(os, "copy_file_range"):
+                try:
+                    # continues from the file positions if the kernel gives up half way
+                    while os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_BUFFER):
+                        pass
+                    method = "copy_file_range"
+                except OSError:
+                    pass
+            if method == "copy":
+                shutil.copyfileobj(fsrc, fdst, COPY_BUFFER)
+    shutil.copystat(src, dst)
+    return method
+
+
+class CompiledTemplate:
+    """ string.Template markers ($name, ${name}) split once into literal text and fields. """
+
+    def __init__(self, text):
+        self.literals, self.fields = [], []
+        literal, pos = [], 0
+        for m in Template.pattern.finditer(text):
+            literal.append(text[pos:m.start()])
+            pos = m.end()
+            if m.group("escaped") is not None:
+                literal.append("$")
+                continue
+            name = m.group("named") or m.group("braced")
+            if name is None:
+                raise ValueError(f"invalid placeholder in template at position {m.start('invalid')}")
+            self.literals.append("".join(literal))
+            self.fields.append(name)
+            literal = []
+        literal.append(text[pos:])
+        self.literals.append("".join(literal))
+
+    def render(self, context) -> str:
+        """Substitute the fields, string values are escaped for use inside JSON strings."""
+        out = [self.literals[0]]
+        for name, literal in zip(self.fields, self.literals[1:]):
+            value = context[name]
+            out.append(json.dumps(str(value))[1:-1] if isinstance(value, (str, Path)) else str(value))
+            out.append(literal)
+        return "".join(out)
+
 
 class HandBrakeJSON:
     """ Holds json settings file that is used as a template. """
 
     template = b"LRx4!F+o`-Q&}7?B<lbH#9x3_P*i7sazF3?>Ob$_`cMU4Hv!$6h?<$3W>h5vLS(?2r?oIfO)_eFnldzK02(v^)M+MadVm=K01SZBKs3+;KnYC*Ax)&38YaqZ5w$%GMw){G28?LR9AwF+m`sd;ff$-FMi6Mz00IdV6u~L&42nFbsp+Yvjf!YAJwP;Rp`i5`1cVlGYu=a$gAki-3;kh{oEntc29rSeQ4%dI?I=2G5CT@DgbaF;LDs<p(9kyPf<R4)Iee>!VcJYex<b~7LIA8$OjRf-^q}n^$x9zi3JBdvfDQ~02;;f}%aJUF;d*cOaWd=coW!G@5tqy5CWY;s-W_b*yjhBfhc>^N>w7FczG0ByX``6>sz|kb{G4f%0^d0~CFL$e#G#=Q%$cA-B+QWE0-^~{ARRO*hYEKIWY8*iigHr|VYrzd9wIzi@-A3)zO0KsGsivR5q5ZtL#cB8aZ@!G9$KJ<5YU>PB@qceB+XVx3s?}DE4^9Rl2@jpxNVm#<6IpXV3aO|HPGmkJG(f9hew<+MnIk-5^!WZ$`9vZt?Buyyb>2~x)Wt<)@qy4TUr1Op#dap=<hx!yN2Fsw*bQJn@FUm*-DNU-=!Mor!2Y;c($5i52vBwG1NQmoqOAN5&KvU6;%6maK6ahm7Qx69V@#}H+boD@<-BLk_NiGHP#?fsg`)X$c~a&u(0iw&*;76)bQW)y>dBGMB(;%=Y<>E&f0pV0?`|)1E}g8ZtdKmGa+t%4mbU?LF$pPc6F;23pEgl0ZWaJ{T!@`o|;YQcK3E9Fp;YcMdmsr4QC{IM?3yV2Y`g4$$=@mz+(j5p<;2{=>(+Xw!WoR6pe0TR8h@Ewx&@M*=QYlgw~$8n03yrZVec{ytNT)oOH@lib+5$Q?o)PH-Qk6hBHk-ARJ->2;-ZI%={X&aVGNb*t8#{w`_=qf{MuukO_mbvdR{1H9J{nos5SIz+`qCIzfgU#+MK!l<}1s>KFH!wbN%|HD@tkM#)1RpmI#xl?E0Dj6^(|hNemAK~*mcTrPp6yg5zi2^#;nVf)QdAxW}65=5I+LmIW6D=1#5>9FCP=Z0WE#0M+Y&y?bvNiWj}=r#433G)Rx$plg&dN~UnAjGGZ*l{V+>kNGaw4ApQXt!JzRhi|T;$6#iQLmX`AWk(5-Ga8DA|X(SpeVCj9r3my=wgmyA)+5a9%}+oPHm}&>4>NO*nLy@X7`p25rXiM+hq{KSz`xcYJl12g60xMOTu>?4NNudY#4&x8TaW-5tIh64k;i~6$vpw9dK8dR7#wIppGp(5`!lB3}-z14sF>)F5TbJnuEl%2BF?WOBo7D`8f^Mvpxd|hT)_%k%+Qmp*k>60C0A1s4jUtdt+M5z)($S<R(Uim`da#JubU*J1!UqRT?*iIi}D!sEE6l83Zb)7DSLlVG^o`mSi^kSGozRTUPH7xb;M$YDpE5;OR1rGK?D*Mnq5<5W5LQ^WJZ}*NIqF3LwPC&w$1g(!&`ZnUXyyR@q$D7Z{A?_h=C@DP2fyr$(@*%x6kSv59?F8qkIgT5p5nvWHC;WEhnNQB?}2>$!R3QYoY|C`wk04Q24Kd+ZG;Uzg5@4&MeR1K6BYPYG<<{}*yaI8cxrE+p#"
     ffprobe = 'ffprobe -loglevel panic -select_streams v:0 -show_streams -print_format json'
+    compiled = None
+    # resolutions by (path, size, mtime) shared by all threads of the process
+    probe_cache = {}
+    probe_lock = threading.Lock()
 
     @classmethod
     def encode(cls, args):
@@ -42,38 +122,74 @@ class HandBrakeJSON:
     def decode(cls):
         return bz2.decompress(base64.b85decode(cls.template)).decode("utf8")
 
+    @classmethod
+    def compile(cls, path=None):
+        """Decode the built-in template, or read a template file, once for all files."""
+        if path:
+            try:
+                text = Path(path).read_text(encoding="utf8")
+            except OSError as e:
+                sys.exit(f"template file {path} can not be read: {e}")
+        else:
+            text = cls.decode()
+        # one job object, the queue writer puts the separators between jobs
+        cls.compiled = CompiledTemplate(text.strip().rstrip(","))
+        return cls.compiled
+
     @classmethod
     def parse(cls, context) -> str:
         """Template must have these markers:
         # ${in}, ${out}, ${fps}, TODO ${skip}, ${resx}, ${resy}
         """
-        t = cls.decode()
+        t = cls.compiled or cls.compile()
         # check for every file... if automatic res.
         if context['res'].startswith('auto'):
-            if not Path(context['in']).is_file():
-                raise RuntimeError(f"ERROR {context['in']} is not accessible! Exit.")
-            print(".", end="", flush=True)
-            vid_info = subprocess.check_output([*cls.ffprobe.split(), context['in']], encoding='utf8')
-            vid_info = json.loads(vid_info)
-            if 'streams' not in vid_info or not vid_info['streams']:
-                raise RuntimeError(f"ERROR {context['in']} has no valid video stream! Exit.")
-            vid_info = vid_info['streams'][0]
-            context['resx'], context['resy'] = vid_info['width'], vid_info['height'] # or coded_width/height
-            # check of video is rotated by 90 degrees and modify width/height if so
-            if vid_info.get('tags') != None and (rot := vid_info['tags'].get('rotate')) != None:
-              try:
-                if abs(int(rot)) == 90:
-                  context['resx'], context['resy'] = context['resy'], context['resx']
-              except ValueError:
-                pass # I know it's bad habit but there is really nothing to do if value is invalid
+            context['resx'], context['resy'] = cls.probe(context['in'])
             if context['res'] == 'auto-half':
                 context['resx'], context['resy'] = context['resx'] // 2, context['resy'] // 2
         else:
             context["resx"], context["resy"] = context.get("res").split("x")
-        # for windows it is definitely required for posix maybe not
-        context["in"] = str(context["in"]).replace("\\", "\\\\")
-        context["out"] = str(context["out"]).replace("\\", "\\\\")
-        return Template(t).substitute(context)
+        # paths are JSON-escaped by render, backslashes of windows paths included
+        return t.render(context)
+
+    @classmethod
+    def probe(cls, path) -> tuple:
+        """Width and height of the first video stream, swapped for videos rotated by 90 degrees.
+        Every file is probed once, later calls are answered from the cache.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise RuntimeError(f"ERROR {path} is not accessible! Exit.")
+        key = (str(path), st.st_size, st.st_mtime_ns)
+        with cls.probe_lock:
+            if key in cls.probe_cache:
+                return cls.probe_cache[key]
+        print(".", end="", flush=True)
+        vid_info = subprocess.check_output([*cls.ffprobe.split(), str(path)], encoding='utf8')
+        vid_info = json.loads(vid_info)
+        if 'streams' not in vid_info or not vid_info['streams']:
+            raise RuntimeError(f"ERROR {path} has no valid video stream! Exit.")
+        vid_info = vid_info['streams'][0]
+        res = vid_info['width'], vid_info['height'] # or coded_width/height
+        # check of video is rotated by 90 degrees and modify width/height if so
+        if vid_info.get('tags') != None and (rot := vid_info['tags'].get('rotate')) != None:
+          try:
+            if abs(int(rot)) == 90:
+              res = res[1], res[0]
+          except ValueError:
+            pass # I know it's bad habit but there is really nothing to do if value is invalid
+        with cls.probe_lock:
+            cls.probe_cache[key] = res
+        return res
+
+    @classmethod
+    def probe_all(cls, paths, jobs):
+        """Probe files concurrently, ffprobe spends most of its time waiting for I/O."""
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for _ in pool.map(cls.probe, paths):
+                pass
+        print()
 
 
 class HandBrakeQueue:
@@ -86,7 +202,7 @@ class HandBrakeQueue:
     Resolutions can now be set to auto or auto-half - this requires ffprobe to be
     installed on your system - and will automatically set the resolutions based on the
     original video, or in case of auto-half to half the size of it (half width and height).
-    Note that using this option will slow down the process as every video file will be checked.
+    Every video file is checked with ffprobe, using -j JOBS processes in parallel.
     """
 
     def __init__(self):
@@ -137,15 +253,38 @@ class HandBrakeQueue:
             choices=["auto", "auto-half", "1280x720", "1440x810"],
             help="out res. of videos, defaults to 1280x720, can be set to auto or auto-half",
         )
+        p.add_argument(
+            "-j",
+            "--jobs",
+            default=os.cpu_count() or 1,
+            type=int,
+            help="ffprobe processes run in parallel for auto resolutions, defaults to cpu count",
+        )
+        p.add_argument(
+            "--copy-jobs",
+            default=8,
+            type=int,
+            help="files copied in parallel to DIR_OUT, defaults to 8",
+        )
         # advanced options to help encode / decode built-in json template
         group = p.add_argument_group(
             "advanced options", "to handle built-in hb json template"
         )
+        group.add_argument(
+            "--template",
+            type=Path,
+            default=None,
+            help="hb json job template file with ${in}, ${out}, ${fps}, ${resx}, ${resy} markers",
+        )
         group.add_argument("--template_enc", action="store_true")
         group.add_argument("--template_dec", action="store_true")
         self.args = p.parse_args()
         self.check_template_commands()
         self.check_for_ffprobe(self.args.res)
+        try:
+            HandBrakeJSON.compile(self.args.template)
+        except ValueError as e:
+            sys.exit(f"template error: {e}")
 
         dir_in = self.args.dir
         if not dir_in.is_absolute():
@@ -158,14 +297,14 @@ class HandBrakeQueue:
                 )  # same as above, windows ramdisk bug
             except FileNotFoundError:
                 sys.exit(f'Please create the DIR_OUT "{dir_out}" before using it!')
-        files_all = self.gather_files(dir_in)
-        files_req = self.gather_files(dir_in, self.args.e)
-        files_diff = set(files_all) - set(files_req)
+        files_req, files_diff = self.gather_files(dir_in, self.args.e)
         if not files_req:
             sys.exit("No files found to be encoded. Use -h for help.")
         if dir_in != dir_out:
             self.copy_out_files_and_dirs(dir_in, dir_out, files_diff)
             self.copy_out_files_and_dirs(dir_in, dir_out, files_req, only_make_dirs=True)
+        if self.args.res.startswith('auto'):
+            HandBrakeJSON.probe_all(files_req, max(1, self.args.jobs))
         hbconf_file = dir_out / "hb.json"
         if self.args.hbconf_file:
             hbconf_file = self.args.hbconf_file
@@ -177,6 +316,7 @@ class HandBrakeQueue:
         print(f"#{len(files)} found to be encoded")
         with open(hbconf, "w", encoding='utf8') as file:
             file.write("[\n")
+            separator = ""
             for f in files:
                 ctx = {
                     "in": f,
@@ -185,30 +325,54 @@ class HandBrakeQueue:
                     "fps": self.args.fps,
                     # "skip": self.args.skip,
                 }
-                file.write(HandBrakeJSON.parse(ctx))
-            file.write("]")
+                file.write(separator + HandBrakeJSON.parse(ctx))
+                separator = ",\n"
+            file.write("\n]\n")
 
     def copy_out_files_and_dirs(self, dir_in, dir_out, files, only_make_dirs=False):
         if dir_in == dir_out or not files:
             return
-        if not only_make_dirs:
-            print(f"#{len(files)} files are not to be encoded copying to {dir_out}")
-        for f in files:
-            out_file = dir_out / f.relative_to(dir_in)
-            if not out_file.parent.exists():
-                out_file.parent.mkdir(parents=True)
-            if not only_make_dirs:
-                shutil.copyfile(f, out_file)
-
-    def gather_files(self, root, extensions=None):
-        reg_p = None
-        if extensions:  # case-insensitive exts
-            reg_p = re.compile(rf".({'|'.join(extensions)})$", re.I)
-        # all_files = [file for x in extensions for file in root.rglob(f"*.{x}")]
-        files = [
-            x for x in root.rglob("*") if reg_p is None or reg_p and reg_p.search(str(x))
-        ]
-        return [f for f in files if f.is_file()]
+        for out_dir in sorted({dir_out / f.parent.relative_to(dir_in) for f in files}):
+            out_dir.mkdir(parents=True, exist_ok=True)
+        if only_make_dirs:
+            return
+        print(f"#{len(files)} files are not to be encoded copying to {dir_out}")
+        start = time.perf_counter()
+        methods = {}
+        copied_bytes = 0
+        with ThreadPoolExecutor(max_workers=max(1, self.args.copy_jobs)) as pool:
+            results = pool.map(lambda f: (f, copy_file(f, dir_out / f.relative_to(dir_in))), files)
+            for f, method in results:
+                methods[method] = methods.get(method, 0) + 1
+                if method:
+                    copied_bytes += f.stat().st_size
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        skipped = methods.pop(None, 0)
+        print(
+            f"#{sum(methods.values())} files copied, {copied_bytes / 1024**2:.1f} MB in {elapsed:.1f}s "
+            f"({copied_bytes / 1024**2 / elapsed:.1f} MB/s"
+            + "".join(f", {n} {m}" for m, n in sorted(methods.items()))
+            + f"), #{skipped} already up to date"
+        )
+
+    def gather_files(self, root, extensions):
+        """Walk the tree once and split the files into (to be encoded, to be copied).
+        Extensions are case-insensitive, directory entries are typed without an extra stat.
+        Only regular files are gathered: broken symlinks, FIFOs and sockets are skipped.
+        """
+        exts = {"." + x.lower().lstrip(".") for x in extensions}
+        files_req, files_diff = [], []
+        stack = [root]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            for entry in entries:
+                if entry.is_file():
+                    f = Path(entry.path)
+                    (files_req if f.suffix.lower() in exts else files_diff).append(f)
+            # Depth first in name order, symlinked directories are not followed
+            stack.extend(entry.path for entry in reversed(entries) if entry.is_dir(follow_symlinks=False))
+        return files_req, files_diff
 
     def check_template_commands(self):
         if self.args.template_enc:
@@ -0,0 +1,142 @@
+# Job queue with parallel workers: every job is converted exactly once and expired leases are reclaimed
+# The conversion is stubbed, so neither ffmpeg nor ffprobe is needed
+import collections
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import convert
+
+TOKEN = "test-token"
+FILES = ["a.mkv", "b.mkv", "c.avi", "d.mkv", "e.avi"]
+
+def setup_queue(tmp_path, monkeypatch):
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    for name in FILES:
+        (source_dir / name).write_bytes(b"media")
+    monkeypatch.setattr(convert, "arg_queue", str(tmp_path / "queue.sqlite"))
+    monkeypatch.setattr(convert, "arg_source_directory", str(source_dir))
+    monkeypatch.setattr(convert, "arg_target_directory", str(tmp_path / "target"))
+    monkeypatch.setattr(convert, "arg_queue_poll", 0.1)
+    monkeypatch.setattr(convert, "_queue", None)
+
+    # Stubbed probe and conversion, counting the conversions of every source
+    converted = collections.Counter()
+    lock = threading.Lock()
+    def probe_source(source, target):
+        return {"source": source, "target": target, "info": None}
+    def convert_file(job, threads=0, progress=None):
+        time.sleep(0.05)
+        with lock:
+            converted[job["source"]] += 1
+        return {"source": job["source"], "target": job["target"], "status": "converted", "elapsed": 0.05}
+    monkeypatch.setattr(convert, "probe_source", probe_source)
+    monkeypatch.setattr(convert, "convert_file", convert_file)
+    return source_dir, converted
+
+def run_workers(backends, wait_for_jobs, stop):
+    workers = [threading.Thread(target=convert.queue_worker, args=(backend, n, 0, stop, wait_for_jobs), daemon=True)
+               for n, backend in enumerate(backends)]
+    for w in workers:
+        w.start()
+    return workers
+
+def job_rows():
+    return convert.job_queue().execute("SELECT source, state, worker FROM jobs ORDER BY id").fetchall()
+
+def close_queue():
+    if convert._queue is not None:
+        convert._queue.close()
+        convert._queue = None
+
+def test_local_workers(tmp_path, monkeypatch):
+    source_dir, converted = setup_queue(tmp_path, monkeypatch)
+    try:
+        assert convert.queue_add(str(source_dir)) == len(FILES)
+        stop = threading.Event()
+        for w in run_workers([convert.LocalQueue(), convert.LocalQueue()], False, stop):
+            w.join(30)
+        assert sorted(state for _, state, _ in job_rows()) == ["done"] * len(FILES)
+        assert converted == collections.Counter({str(source_dir / name): 1 for name in FILES})
+    finally:
+        close_queue()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def test_coordinator_workers(tmp_path, monkeypatch):
+    source_dir, converted = setup_queue(tmp_path, monkeypatch)
+    url = "http://127.0.0.1:%s" % free_port()
+    coordinator = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "convert.py"), "--queue", convert.arg_queue,
+         "-t", convert.arg_target_directory, "coordinator", "--listen", url[len("http://"):], "--token", TOKEN, str(source_dir)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    stop = threading.Event()
+    try:
+        request = urllib.request.Request(url + "/status", headers={convert.COORDINATOR_TOKEN_HEADER: TOKEN})
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(request, timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        # A worker on another host claims the first job and disappears, its lease runs out after a second
+        monkeypatch.setattr(convert, "arg_lease_seconds", 1)
+        lost = convert.queue_claim("lost-host:1:0")
+        assert lost is not None
+
+        backends = [convert.RemoteQueue(url, token=TOKEN), convert.RemoteQueue(url, token=TOKEN)]
+        run_workers(backends, True, stop)
+        deadline = time.time() + 30
+        while time.time() < deadline and convert.queue_counts() != {"done": len(FILES)}:
+            time.sleep(0.2)
+
+        rows = job_rows()
+        assert [state for _, state, _ in rows] == ["done"] * len(FILES)
+        assert all(not worker.startswith("lost-host:") for _, _, worker in rows)
+        assert converted == collections.Counter({str(source_dir / name): 1 for name in FILES})
+    finally:
+        stop.set()
+        coordinator.terminate()
+        coordinator.wait(10)
+        close_queue()
+
+# A coordinator that cannot be reached while a job runs
+class UnreachableQueue:
+    def __init__(self):
+        self.claims = 0
+
+    def claim(self, worker):
+        self.claims += 1
+        return {"id": self.claims, "source": "/nowhere/a.mkv", "target": "/nowhere/a.mkv"} if self.claims == 1 else None
+
+    def renew(self, job_id, worker, state=None):
+        raise OSError("connection refused")
+
+    def complete(self, job_id, worker, state, error=None, metrics=None):
+        raise OSError("connection refused")
+
+    def paused(self):
+        return False
+
+def test_worker_survives_unreachable_coordinator(tmp_path, monkeypatch):
+    setup_queue(tmp_path, monkeypatch)
+    backend = UnreachableQueue()
+    stop = threading.Event()
+    worker = run_workers([backend], True, stop)[0]
+    deadline = time.time() + 10
+    while time.time() < deadline and backend.claims < 3:
+        time.sleep(0.1)
+    stop.set()
+    worker.join(10)
+    assert backend.claims >= 3
@@ -0,0 +1,87 @@
+# Startup time budget: `convert.py --help` and probing a single file only import what they need,
+# the heavy modules (sqlite3, http, concurrent.futures, ...) are imported lazily
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import convert
+
+BUDGET_SECONDS = 0.5
+CONVERT = os.path.join(ROOT, "convert.py")
+
+def timed_run(args, env=None):
+    start = time.time()
+    result = subprocess.run([sys.executable, CONVERT] + args, stdout=subprocess.PIPE, text=True, env=env)
+    return time.time() - start, result
+
+def test_help_startup_time():
+    elapsed, result = timed_run(["--help"])
+    assert result.returncode == 0
+    assert elapsed < BUDGET_SECONDS, "convert.py --help took %.2f seconds, the budget is %s seconds" % (
+        elapsed, BUDGET_SECONDS)
+
+# Probe results and ffmpeg capabilities of an h264/aac mkv, as the caches hold them
+PROBE_RESULTS = {
+    "format": {"duration": "10", "format_name": "matroska,webm", "size": "1000", "bit_rate": "800"},
+    "streams": [{"index": 0, "codec_type": "video", "codec_name": "h264", "width": 1920, "height": 1080,
+                 "pix_fmt": "yuv420p", "avg_frame_rate": "25/1"},
+                {"index": 1, "codec_type": "audio", "codec_name": "aac", "channels": 2}],
+}
+
+def capabilities():
+    def codec(codec_type, coder):
+        return {"type": codec_type, "decode": True, "encode": True, "intra_only": False, "lossy": True,
+                "lossless": False, "decoders": [coder], "encoders": [coder], "description": coder}
+    def coder(codec_type):
+        return {"type": codec_type, "frame_threads": True, "slice_threads": True, "experimental": False,
+                "draw_horiz_band": False, "direct_rendering": False, "description": ""}
+    return {"codecs": {"h264": codec("video", "h264"), "aac": codec("audio", "aac")},
+            "encoders": {"h264": coder("video"), "aac": coder("audio")},
+            "decoders": {"h264": coder("video"), "aac": coder("audio")},
+            "demuxers": ["matroska", "webm"], "muxers": ["matroska"], "dispositions": ["default", "forced"]}
+
+# Probing a file answered from the probe and capability caches, without running ffmpeg or ffprobe
+def test_probe_startup_time():
+    with tempfile.TemporaryDirectory() as home:
+        # ffmpeg and ffprobe that fail, a cache miss shows up as a failed probe
+        bin_dir = os.path.join(home, "bin")
+        os.mkdir(bin_dir)
+        for name in ("ffmpeg", "ffprobe"):
+            with open(os.path.join(bin_dir, name), "w") as f:
+                f.write("#!/bin/sh\nexit 1\n")
+            os.chmod(os.path.join(bin_dir, name), 0o755)
+        ffmpeg = os.path.realpath(os.path.join(bin_dir, "ffmpeg"))
+        capabilities_path = os.path.expanduser(convert.arg_ffmpeg_capabilities.replace("~", home, 1))
+        os.makedirs(os.path.dirname(capabilities_path))
+        with open(capabilities_path, "w") as f:
+            json.dump({"key": {"binary": ffmpeg, "mtime_ns": os.stat(ffmpeg).st_mtime_ns},
+                       "capabilities": capabilities()}, f)
+
+        source = os.path.join(home, "movie.mkv")
+        with open(source, "wb") as f:
+            f.write(b"media")
+        probe_cache = os.path.join(home, "ffprobe.sqlite")
+        default_probe_cache, convert.arg_probe_cache = convert.arg_probe_cache, probe_cache
+        try:
+            convert.probe_cache_put(source, os.stat(source), PROBE_RESULTS)
+        finally:
+            convert._probe_cache.close()
+            convert._probe_cache = None
+            convert.arg_probe_cache = default_probe_cache
+
+        env = dict(os.environ, HOME=home, PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""))
+        elapsed, result = timed_run(["--probe-cache", probe_cache, "probe", source], env)
+        assert result.returncode == 0
+        assert "format = matroska,webm" in result.stdout, result.stdout
+        assert elapsed < BUDGET_SECONDS, "convert.py probe took %.2f seconds, the budget is %s seconds" % (
+            elapsed, BUDGET_SECONDS)
+
+if __name__ == "__main__":
+    test_help_startup_time()
+    test_probe_startup_time()
+    print("convert.py --help and probe started within %s seconds" % BUDGET_SECONDS)